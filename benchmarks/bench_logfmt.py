@@ -0,0 +1,56 @@
+"""
+Microbenchmark for LogfmtFormatter and JSONLinesFormatter.
+
+Run from the repository root with::
+
+    $ python -m benchmarks.bench_logfmt
+"""
+
+import logging
+import timeit
+
+from sfdo_template_helpers.logfmt_utils import JSONLinesFormatter, LogfmtFormatter
+
+NUMBER = 50000
+
+
+def make_record(module="views", msg='Rendered "home" page', **extra):
+    record = logging.LogRecord("bench", logging.INFO, module, 1, msg, (), None)
+    record.__dict__.update(extra)
+    return record
+
+
+RECORDS = {
+    "plain": make_record(),
+    "tagged": make_record(
+        tag="oauth",
+        job_id="3f0c9bde",
+        context={"org_id": "00D000000000001EAA", "attempt": 2, "ok": True},
+    ),
+    "middleware": make_record(
+        module="logging_middleware", msg="method=GET path=/ status=200 time=12"
+    ),
+    "nested": make_record(
+        context={
+            "org": {f"field_{i}": i for i in range(10)},
+            "user": {"id": 1, "name": "someone", "perms": ["read", "write"]},
+            "request": {f"header_{i}": f"value {i}" for i in range(12)},
+            "ok": True,
+        }
+    ),
+    "structured": make_record(
+        msg={"method": "GET", "path": "/", "status": 200, "time": 12}
+    ),
+}
+
+
+def main():
+    for formatter in (LogfmtFormatter(), JSONLinesFormatter()):
+        print(type(formatter).__name__)
+        for name, record in RECORDS.items():
+            seconds = timeit.timeit(lambda: formatter.format(record), number=NUMBER)
+            print(f"{name:>12}: {NUMBER / seconds:>10,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
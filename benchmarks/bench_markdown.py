@@ -0,0 +1,78 @@
+"""
+Microbenchmark for MarkdownField rendering.
+
+Compares the module-level markdown() and bleach.clean() functions, which
+build a new converter and cleaner for every document, with
+MarkdownField.render, which reuses one of each per thread; then rendering
+a list page's worth of documents row by row with MarkdownField.render_many,
+serially and in a process pool.
+
+Run from the repository root with::
+
+    $ python -m benchmarks.bench_markdown
+"""
+
+import time
+import timeit
+
+import bleach
+from django.conf import settings
+from markdown import markdown
+
+settings.configure()
+
+from sfdo_template_helpers.fields import MarkdownField  # noqa: E402
+
+NUMBER = 2000
+# A list page: 500 rows, half of them sharing a description with another.
+BULK_ROWS = 500
+BULK_DISTINCT = 250
+
+DOCUMENTS = {
+    "short": "Some *emphasized* text with a [link](https://example.com).",
+    "medium": "\n\n".join(
+        [
+            "# Heading",
+            "A paragraph with **bold**, `code` and <script>alert(1)</script>.",
+            "* one\n* two\n* three",
+            "> A quote.",
+        ]
+        * 5
+    ),
+}
+
+
+def main():
+    field = MarkdownField()
+
+    def per_call(document):
+        return bleach.clean(
+            markdown(document),
+            tags=field.allowed_tags,
+            attributes=field.allowed_attrs,
+        )
+
+    for name, document in DOCUMENTS.items():
+        assert per_call(document) == field.render(document)
+        for label, render in (("per call", per_call), ("reused", field.render)):
+            seconds = timeit.timeit(lambda: render(document), number=NUMBER)
+            print(f"{name:>8} {label:>9}: {NUMBER / seconds:>8,.0f} docs/s")
+
+    rows = [
+        f"{DOCUMENTS['medium']}\n\nRow {i % BULK_DISTINCT}" for i in range(BULK_ROWS)
+    ]
+    bulk = {
+        "per row": lambda: [field.render(row) for row in rows],
+        "render_many, serial": lambda: field.render_many(rows),
+        "render_many, pool": lambda: field.render_many(rows),
+    }
+    for label, render in bulk.items():
+        settings.MARKDOWN_BULK_WORKERS = 0 if label.endswith("serial") else None
+        render()  # Start the pool, if any.
+        start = time.perf_counter()
+        render()
+        print(f"{label:>20}: {time.perf_counter() - start:>6.3f}s for {BULK_ROWS} rows")
+
+
+if __name__ == "__main__":
+    main()
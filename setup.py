@@ -52,7 +52,10 @@ setup(
     extras_require={
         "test": [
             "django-allauth",
-        ]
+        ],
+        "json": [
+            "orjson",
+        ],
     },
     # https://stackoverflow.com/a/16576850
     include_package_data=True,
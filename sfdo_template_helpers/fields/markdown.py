@@ -6,32 +6,198 @@ rendering with `bleach` and `markdown`.  When used in a model,
 `fieldname_html` renders the safe html.
 """
 
-from django.db import models
+import functools
+import hashlib
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import re
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.validators import MaxLengthValidator
+from django.db import models, transaction
+from django.db.models.query_utils import DeferredAttribute
+from django.utils.functional import Promise, cached_property
 from django.utils.translation import gettext_lazy as _
 from django.utils.safestring import mark_safe
 
 import bleach
-from markdown import markdown
+from markdown import Markdown
+
+from ..cache import LocalLRUCache
+
+# Rendered HTML shared by every MarkdownField in the process, keyed by a hash
+# of the Markdown and the field's allowlists. Sized by the
+# MARKDOWN_RENDER_CACHE_SIZE setting; off by default.
+markdown_render_cache = LocalLRUCache()
+
+logger = logging.getLogger(__name__)
+
+# The blank line between two Markdown blocks.
+BLOCK_BREAK_RE = re.compile(r"\r?\n[ \t]*\r?\n")
+# The end of the last word in a string.
+LAST_WORD_RE = re.compile(r"\S*\Z")
+# The comment stored HTML starts with, holding the digest of its Markdown.
+STORED_DIGEST_RE = re.compile(r"<!--md:([0-9a-f]{32})-->")
+
+RerenderProgress = namedtuple("RerenderProgress", ("rows", "last_pk", "updated"))
+
+_executor_lock = threading.Lock()
+# The pool, and the (pid, workers) it was started for.
+_executor = None
+_executor_key = None
+# Fields built in pool workers, by their allowlists.
+_worker_fields = {}
+
+
+def _get_executor(workers):
+    global _executor, _executor_key
+    with _executor_lock:
+        # A pool doesn't survive a fork, so each process starts its own.
+        if _executor_key != (os.getpid(), workers):
+            if _executor is not None and _executor_key[0] == os.getpid():
+                _executor.shutdown(wait=False)
+            # Workers are spawned rather than forked, as forking a web worker
+            # that runs other threads can copy locks they hold.
+            _executor = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context("spawn")
+            )
+            _executor_key = (os.getpid(), workers)
+        return _executor
+
+
+def _render_chunk(allowed_tags, allowed_attrs, raw_mds):
+    key = repr((allowed_tags, allowed_attrs))
+    field = _worker_fields.get(key)
+    if field is None:
+        field = _worker_fields[key] = MarkdownField(
+            allowed_tags=allowed_tags, allowed_attrs=allowed_attrs
+        )
+    return [field._render(raw_md) for raw_md in raw_mds]
+
+
+def render_markdown(instances, field_name):
+    """
+    Return the HTML of the named MarkdownField for every instance in a list
+    or queryset, as MarkdownFieldMixin.get_html_many does.
+    """
+    instances = list(instances)
+    if not instances:
+        return []
+    return instances[0]._meta.get_field(field_name).get_html_many(instances)
+
+
+@functools.total_ordering
+class LazyHTML(Promise):
+    """
+    The HTML of a MarkdownField, rendered the first time it's used as a
+    string. Whether it's truthy is decided from the Markdown, so checking it,
+    as in ``{% if product.description_html %}``, renders nothing: it's false
+    for blank Markdown, and for Markdown over the render length limit.
+
+    Like Django's lazy strings, it's a Promise, so templates, force_str and
+    Django's JSON encoder turn it into a string.
+    """
+
+    def __init__(self, field, instance, raw_md, excerpt=False):
+        self._field = field
+        self._instance = instance
+        self._raw_md = raw_md
+        self._excerpt = excerpt
+
+    def __str__(self):
+        return self._field.get_html(self._instance, self._raw_md, self._excerpt)
+
+    def __bool__(self):
+        raw_md = self._raw_md
+        if self._excerpt:
+            raw_md = self._field.excerpt(raw_md)
+        if not raw_md.strip():
+            return False
+        # Markdown over the limit renders as "".
+        max_length = self._field._get_max_render_length()
+        return max_length is None or len(raw_md) <= max_length
+
+    def __repr__(self):
+        return f"{type(self).__name__}({str(self)!r})"
+
+    def __eq__(self, other):
+        if isinstance(other, LazyHTML):
+            other = str(other)
+        return str(self) == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __lt__(self, other):
+        if isinstance(other, LazyHTML):
+            other = str(other)
+        return str(self) < other
+
+    def __len__(self):
+        return len(str(self))
+
+    def __contains__(self, item):
+        return item in str(self)
+
+    def __iter__(self):
+        return iter(str(self))
+
+    def __getitem__(self, key):
+        return str(self)[key]
+
+    def __add__(self, other):
+        return str(self) + other
+
+    def __radd__(self, other):
+        return other + str(self)
+
+    def __mod__(self, other):
+        return str(self) % other
+
+    def __mul__(self, n):
+        return str(self) * n
+
+    __rmul__ = __mul__
+
+    def __format__(self, format_spec):
+        return format(str(self), format_spec)
+
+    def __getattr__(self, name):
+        # Other str methods, like startswith() and split().
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(str(self), name)
+
+
+class LazySafeHTML(LazyHTML):
+    """A LazyHTML that's marked safe, as a SafeString would be."""
+
+    def __str__(self):
+        return mark_safe(super().__str__())
+
+    def __html__(self):
+        return str(self)
 
 
 class MarkdownDescriptor(object):
-    def __init__(self, field):
+    def __init__(self, field, excerpt=False):
         self.field = field
+        self.excerpt = excerpt
 
     def __get__(self, instance, owner):
         if instance is None:
             raise AttributeError("Can only be accessed via an instance.")
         raw_md = instance.__dict__[self.field.name]
         if raw_md is None:
-            return ""
-        result = bleach.clean(
-                markdown(raw_md),
-                tags=self.field.allowed_tags,
-                attributes=self.field.allowed_attrs,
-            )
-        if self.field.is_safe:
-            result = mark_safe(result)
-        return result
+            return mark_safe("") if self.field.is_safe else ""
+        lazy_class = LazySafeHTML if self.field.is_safe else LazyHTML
+        return lazy_class(self.field, instance, raw_md, self.excerpt)
 
     def __set__(self, obj, value):
         raise AttributeError("Read-only Attribute.")
@@ -70,6 +236,9 @@ class MarkdownFieldMixin:
 
     property_suffix = "_html"
 
+    excerpt_blocks = 1
+    excerpt_length = 300
+
     description = _("Field containing Markdown formatted text.")
 
     def __init__(self, *args, **kwargs):
@@ -83,6 +252,15 @@ class MarkdownFieldMixin:
         self.is_safe = kwargs.pop("is_safe", True)
         self.allowed_tags = kwargs.pop("allowed_tags", MarkdownField.allowed_tags)
         self.allowed_attrs = kwargs.pop("allowed_attrs", MarkdownField.allowed_attrs)
+        # Keep the rendered HTML in a column of its own, filled in on save.
+        self.store_html = kwargs.pop("store_html", False)
+        # Markdown longer than this is rendered as an empty string, and
+        # doesn't validate. Defaults to the MARKDOWN_MAX_RENDER_LENGTH setting.
+        self.max_render_length = kwargs.pop("max_render_length", None)
+        # The <name>_excerpt_html property renders up to this many blocks
+        # (paragraphs, lists and the like) and characters of the start.
+        self.excerpt_blocks = kwargs.pop("excerpt_blocks", MarkdownField.excerpt_blocks)
+        self.excerpt_length = kwargs.pop("excerpt_length", MarkdownField.excerpt_length)
         super().__init__(*args, **kwargs)
 
     def deconstruct(self):
@@ -96,16 +274,358 @@ class MarkdownFieldMixin:
             kwargs["allowed_tags"] = self.allowed_tags
         if self.allowed_attrs != MarkdownField.allowed_attrs:
             kwargs["allowed_attrs"] = self.allowed_attrs
+        if self.store_html:
+            kwargs["store_html"] = True
+        if self.max_render_length is not None:
+            kwargs["max_render_length"] = self.max_render_length
+        if self.excerpt_blocks != MarkdownField.excerpt_blocks:
+            kwargs["excerpt_blocks"] = self.excerpt_blocks
+        if self.excerpt_length != MarkdownField.excerpt_length:
+            kwargs["excerpt_length"] = self.excerpt_length
         return name, path, args, kwargs
 
+    def _get_max_render_length(self):
+        if self.max_render_length is not None:
+            return self.max_render_length
+        return getattr(settings, "MARKDOWN_MAX_RENDER_LENGTH", None)
+
+    @cached_property
+    def validators(self):
+        validators = super().validators
+        max_length = self._get_max_render_length()
+        if max_length is not None:
+            validators = [*validators, MaxLengthValidator(max_length)]
+        return validators
+
     @property
     def html_field_name(self):
         return self.name + self.property_suffix
 
+    @property
+    def excerpt_field_name(self):
+        return self.name + "_excerpt" + self.property_suffix
+
+    @property
+    def html_column_name(self):
+        return self.html_field_name + "_stored"
+
+    @property
+    def html_cache_name(self):
+        return "_" + self.html_field_name + "_cache"
+
+    @property
+    def excerpt_cache_name(self):
+        return "_" + self.excerpt_field_name + "_cache"
+
+    @cached_property
+    def allowlist_key(self):
+        attrs = self.allowed_attrs
+        if isinstance(attrs, dict):
+            attrs = sorted(attrs.items())
+        return repr((sorted(self.allowed_tags), attrs))
+
+    @cached_property
+    def _renderers(self):
+        # Neither Markdown nor bleach's Cleaner is thread-safe, so each thread
+        # gets its own pair, built once from this field's allowlists.
+        return threading.local()
+
+    def _render(self, raw_md):
+        renderers = self._renderers
+        try:
+            converter, cleaner = renderers.converter, renderers.cleaner
+        except AttributeError:
+            converter = renderers.converter = Markdown()
+            cleaner = renderers.cleaner = bleach.Cleaner(
+                tags=self.allowed_tags, attributes=self.allowed_attrs
+            )
+        try:
+            html = converter.convert(raw_md)
+        finally:
+            # Clears reference links and the like from this document.
+            converter.reset()
+        return cleaner.clean(html)
+
+    def _cache_key(self, raw_md):
+        return (
+            hashlib.blake2b(raw_md.encode("utf-8"), digest_size=16).digest(),
+            self.allowlist_key,
+        )
+
+    def _too_long(self, raw_md):
+        max_length = self._get_max_render_length()
+        if max_length is None or len(raw_md) <= max_length:
+            return False
+        logger.warning(
+            "Not rendering %s Markdown of %d characters, over the limit of %d.",
+            self,
+            len(raw_md),
+            max_length,
+        )
+        return True
+
+    def render(self, raw_md):
+        """
+        Render Markdown as bleached HTML, going through the shared
+        markdown_render_cache when MARKDOWN_RENDER_CACHE_SIZE is set.
+        Markdown over the length limit is rendered as an empty string.
+        """
+        if self._too_long(raw_md):
+            return ""
+        max_size = getattr(settings, "MARKDOWN_RENDER_CACHE_SIZE", 0)
+        if not max_size:
+            return self._render(raw_md)
+        key = self._cache_key(raw_md)
+        result = markdown_render_cache.get(key)
+        if result is None:
+            result = self._render(raw_md)
+            markdown_render_cache.set(key, result, math.inf, max_size)
+        return result
+
+    def render_many(self, raw_mds):
+        """
+        Render many Markdown strings, returning a dict of HTML by Markdown, so
+        each distinct string is rendered once.
+
+        When there are at least MARKDOWN_BULK_PROCESS_THRESHOLD (200) strings
+        left to render after the shared cache, they're rendered in a process
+        pool of MARKDOWN_BULK_WORKERS processes (None for one per CPU). The
+        pool is off by default.
+        """
+        pending = set(raw_mds)
+        pending.discard(None)
+        threshold = getattr(settings, "MARKDOWN_BULK_PROCESS_THRESHOLD", 200)
+        workers = getattr(settings, "MARKDOWN_BULK_WORKERS", 0)
+        if workers is None:
+            workers = os.cpu_count()
+        if not workers or len(pending) < threshold:
+            return {raw_md: self.render(raw_md) for raw_md in pending}
+
+        rendered = {raw_md: "" for raw_md in pending if self._too_long(raw_md)}
+        pending.difference_update(rendered)
+        max_size = getattr(settings, "MARKDOWN_RENDER_CACHE_SIZE", 0)
+        if max_size:
+            for raw_md in pending:
+                result = markdown_render_cache.get(self._cache_key(raw_md))
+                if result is not None:
+                    rendered[raw_md] = result
+            pending.difference_update(rendered)
+        # A few chunks per worker evens out documents of different lengths.
+        pending = list(pending)
+        chunks = [pending[i :: workers * 4] for i in range(workers * 4)]
+        results = _get_executor(workers).map(
+            _render_chunk,
+            itertools.repeat(self.allowed_tags),
+            itertools.repeat(self.allowed_attrs),
+            chunks,
+        )
+        for chunk, htmls in zip(chunks, results):
+            rendered.update(zip(chunk, htmls))
+            if max_size:
+                for raw_md, html in zip(chunk, htmls):
+                    markdown_render_cache.set(
+                        self._cache_key(raw_md), html, math.inf, max_size
+                    )
+        return rendered
+
+    def get_html_many(self, instances):
+        """
+        Return this field's HTML for each of the instances, as the _html
+        property would, rendering the Markdown with render_many and
+        memoizing it on the instances.
+        """
+        cache_name = self.html_cache_name
+        pending = []
+        for instance in instances:
+            raw_md = instance.__dict__[self.attname]
+            cached = instance.__dict__.get(cache_name)
+            if cached is None or cached[0] != raw_md:
+                pending.append(raw_md)
+        rendered = self.render_many(pending)
+        results = []
+        for instance in instances:
+            raw_md = instance.__dict__[self.attname]
+            if raw_md in rendered:
+                instance.__dict__[cache_name] = (raw_md, rendered[raw_md])
+            html = self.get_html(instance)
+            results.append(mark_safe(html) if self.is_safe else html)
+        return results
+
+    def excerpt(self, raw_md):
+        """
+        Return the start of the Markdown: its first ``excerpt_blocks`` blocks,
+        cut to ``excerpt_length`` characters with an ellipsis if they're
+        longer. Only that many characters are looked at.
+        """
+        raw_md = raw_md.lstrip("\r\n")
+        start = raw_md[: self.excerpt_length + 1]
+        if self.excerpt_blocks:
+            breaks = itertools.islice(
+                BLOCK_BREAK_RE.finditer(start), self.excerpt_blocks - 1, None
+            )
+            block_break = next(breaks, None)
+            if block_break is not None:
+                return start[: block_break.start()]
+        if len(start) <= self.excerpt_length:
+            return start
+        cut = start[: self.excerpt_length]
+        if not start[-1].isspace():
+            # Drop the word that was cut in two, unless it's the only one.
+            cut = LAST_WORD_RE.sub("", cut) or cut
+        return cut.rstrip() + "…"
+
+    def get_html(self, instance, raw_md=None, excerpt=False):
+        """
+        Return the rendered HTML for this field on the instance, or for
+        ``raw_md`` if it's given, memoizing it on the instance. With
+        ``excerpt``, render only the excerpt of the Markdown.
+        """
+        if raw_md is None:
+            raw_md = instance.__dict__[self.name]
+        if raw_md is None:
+            return ""
+        # The HTML is memoized on the instance along with the Markdown it was
+        # rendered from, so changing the field invalidates it.
+        cache_name = self.excerpt_cache_name if excerpt else self.html_cache_name
+        cached = instance.__dict__.get(cache_name)
+        if cached is not None and cached[0] == raw_md:
+            return cached[1]
+        result = self.render(self.excerpt(raw_md) if excerpt else raw_md)
+        instance.__dict__[cache_name] = (raw_md, result)
+        return result
+
     def contribute_to_class(self, cls, name, private_only=False):
         super().contribute_to_class(cls, name, private_only)
         setattr(cls, self.html_field_name, MarkdownDescriptor(self))
+        setattr(cls, self.excerpt_field_name, MarkdownDescriptor(self, excerpt=True))
+        if self.store_html and not cls._meta.abstract:
+            cls.add_to_class(self.html_column_name, StoredHTMLField(source=name))
+
+    def rerender(self, batch_size=500, start_after=None):
+        """
+        Re-render the stored HTML column of every row, e.g. after changing
+        ``allowed_tags`` or ``allowed_attrs``, and save the rows whose HTML
+        changed.
+
+        Rows are streamed in primary key order, starting after the
+        ``start_after`` pk, and each batch of ``batch_size`` rows is saved in
+        its own transaction. Yields a ``RerenderProgress`` after each batch.
+        """
+        column = self.html_column_name
+        queryset = (
+            self.model._default_manager.order_by("pk")
+            .exclude(**{self.attname: None})
+            .only("pk", self.attname, column)
+        )
+        if start_after is not None:
+            queryset = queryset.filter(pk__gt=start_after)
+        rows = queryset.iterator(chunk_size=batch_size)
+        for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+            changed = []
+            for instance in batch:
+                raw_md = getattr(instance, self.attname)
+                html = StoredHTML(self.render(raw_md), markdown_digest(raw_md))
+                stored = getattr(instance, column)
+                if html != stored or html.digest != getattr(stored, "digest", None):
+                    setattr(instance, column, html)
+                    changed.append(instance)
+            with transaction.atomic():
+                self.model._default_manager.bulk_update(changed, [column])
+            yield RerenderProgress(len(batch), batch[-1].pk, len(changed))
 
 
 class MarkdownField(MarkdownFieldMixin, models.TextField):
     pass
+
+
+def markdown_digest(raw_md):
+    return hashlib.blake2b(raw_md.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class StoredHTML(str):
+    """
+    HTML rendered by pre_save or rerender, with the digest of the Markdown it
+    was rendered from, which is stored with it.
+    """
+
+    def __new__(cls, html, digest=None):
+        self = super().__new__(cls, html)
+        self.digest = digest
+        return self
+
+
+class StoredHTMLAttribute(DeferredAttribute):
+    """
+    Seeds the source field's memoized HTML when the stored HTML was rendered
+    from the Markdown loaded with it, so the _html property reads it without
+    rendering for as long as the Markdown is unchanged. HTML stored for other
+    Markdown, e.g. after a QuerySet.update() of the Markdown, or assigned to
+    the column, is ignored by the _html property, and replaced on save.
+    """
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.field.attname] = value
+        source = instance._meta.get_field(self.field.source)
+        raw_md = instance.__dict__.get(source.attname)
+        if (
+            isinstance(value, StoredHTML)
+            and raw_md is not None
+            and value.digest == markdown_digest(raw_md)
+        ):
+            instance.__dict__[source.html_cache_name] = (raw_md, str(value))
+
+
+class StoredHTMLField(models.TextField):
+    """
+    The column a ``MarkdownField(store_html=True)`` adds to its model to hold
+    its rendered HTML, which is filled in on save.
+    """
+
+    descriptor_class = StoredHTMLAttribute
+
+    def __init__(self, *args, source, **kwargs):
+        self.source = source
+        kwargs.setdefault("null", True)
+        kwargs.setdefault("editable", False)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs["source"] = self.source
+        return name, path, args, kwargs
+
+    def contribute_to_class(self, cls, name, private_only=False):
+        # The MarkdownField adds this field, and so do migrations, which
+        # record it too. Whichever comes second is skipped.
+        if any(field.name == name for field in cls._meta.local_fields):
+            return
+        super().contribute_to_class(cls, name, private_only)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return None
+        match = STORED_DIGEST_RE.match(value)
+        if match is None:
+            return StoredHTML(value)
+        return StoredHTML(value[match.end() :], match.group(1))
+
+    def get_prep_value(self, value):
+        value = super().get_prep_value(value)
+        if isinstance(value, StoredHTML) and value.digest is not None:
+            # An HTML comment, so the column is still plain HTML.
+            return f"<!--md:{value.digest}-->{value}"
+        return value
+
+    def pre_save(self, model_instance, add):
+        source = model_instance._meta.get_field(self.source)
+        if source.attname not in model_instance.__dict__:
+            # The Markdown is deferred, so it hasn't changed.
+            return super().pre_save(model_instance, add)
+        # Always render, rather than trust the memoized HTML, which may have
+        # come from an assignment to this field.
+        raw_md = model_instance.__dict__[source.attname]
+        html = None
+        if raw_md is not None:
+            html = StoredHTML(source.render(raw_md), markdown_digest(raw_md))
+        setattr(model_instance, self.attname, html)
+        return html
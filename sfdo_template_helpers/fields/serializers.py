@@ -0,0 +1,49 @@
+from django.db import models
+from rest_framework import serializers
+from rest_framework.fields import get_attribute
+
+
+class MarkdownHTMLField(serializers.ReadOnlyField):
+    """
+    Serializes the HTML of a MarkdownField, named by ``source``::
+
+        description_html = MarkdownHTMLField(source="description")
+
+    Under a list serializer, the first row renders the field for every row
+    at once, with MarkdownFieldMixin.render_many, and later rows read the
+    result. A nested list serializer has no instance to read the rows from,
+    so each row is rendered as it's serialized.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._rendered = None
+
+    def get_attribute(self, instance):
+        # The object that has the MarkdownField.
+        return get_attribute(instance, self.source_attrs[:-1])
+
+    def _render_list(self, field, rows):
+        if isinstance(rows, models.Manager):
+            rows = rows.all()
+        instances = [get_attribute(row, self.source_attrs[:-1]) for row in rows]
+        raw_mds = [
+            instance.__dict__[field.attname]
+            for instance in instances
+            if instance is not None
+        ]
+        return field.render_many(raw_mds)
+
+    def to_representation(self, value):
+        field = value._meta.get_field(self.source_attrs[-1])
+        list_serializer = self.parent.parent
+        if (
+            self._rendered is None
+            and isinstance(list_serializer, serializers.ListSerializer)
+            and list_serializer.instance is not None
+        ):
+            self._rendered = self._render_list(field, list_serializer.instance)
+        raw_md = value.__dict__[field.attname]
+        if self._rendered and raw_md in self._rendered:
+            value.__dict__[field.html_cache_name] = (raw_md, self._rendered[raw_md])
+        return str(field.get_html(value))
@@ -0,0 +1,290 @@
+"""
+Streaming analysis of logs written by LogfmtFormatter.
+
+Files are read through mmap and split into chunks at line boundaries, which
+are parsed in parallel in a process pool; stdin is read in batches of lines.
+Each chunk is reduced to a LogStats, and the partial LogStats are merged, so
+memory use depends on the number of distinct tags, modules and fields, not on
+the size of the log.
+"""
+
+import heapq
+import math
+import mmap
+import os
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+# Mirrors LogfmtFormatter: values are either bare, or quoted with only the
+# double quote escaped, as \".
+PAIR_RE = re.compile(rb'([^\s=]+)=(?:"([^"]*(?:(?<=\\)"[^"]*)*)"|(\S*))')
+# Fields every LogfmtFormatter line has, which are never numeric context.
+HEADER_FIELDS = frozenset([b"id", b"at", b"time", b"tag", b"module", b"msg"])
+ERROR_LEVELS = frozenset([b"ERROR", b"CRITICAL"])
+
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+STREAM_BATCH_LINES = 100000
+
+
+def parse_line(line):
+    """Parse one logfmt line (str or bytes) into a dict of strings."""
+    if isinstance(line, str):
+        line = line.encode("utf-8")
+    fields = {}
+    for match in PAIR_RE.finditer(line):
+        key, quoted, bare = match.groups()
+        value = bare if quoted is None else quoted.replace(b'\\"', b'"')
+        fields[key.decode("utf-8", "replace")] = value.decode("utf-8", "replace")
+    return fields
+
+
+class Histogram:
+    """
+    A mergeable histogram with logarithmic buckets, for estimating
+    percentiles to within about 1% without keeping every value.
+    """
+
+    GROWTH = 1.02
+    _LOG_GROWTH = math.log(GROWTH)
+
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, value):
+        if value == 0:
+            key = (0, 0)
+        else:
+            key = (
+                1 if value > 0 else -1,
+                math.floor(math.log(abs(value)) / self._LOG_GROWTH),
+            )
+        self.buckets[key] += 1
+        self.count += 1
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def _value(self, key):
+        sign, index = key
+        if sign == 0:
+            return 0.0
+        # The geometric middle of the bucket.
+        return sign * self.GROWTH ** (index + 0.5)
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(p / 100 * self.count))
+        # The extremes are known exactly.
+        if rank == 1:
+            return self.min
+        if rank == self.count:
+            return self.max
+        seen = 0
+        for key in sorted(self.buckets, key=self._value):  # pragma: no branch
+            seen += self.buckets[key]
+            if seen >= rank:
+                return min(max(self._value(key), self.min), self.max)
+
+
+class LogStats:
+    """Aggregates over some LogfmtFormatter lines."""
+
+    def __init__(self, duration_field="duration_ms", top=10):
+        self.duration_field = duration_field.encode("utf-8")
+        self.top = top
+        self.lines = 0
+        self.errors_by_tag = Counter()
+        self.errors_by_module = Counter()
+        self.fields = {}
+        # A min-heap of the `top` slowest (duration, id) pairs.
+        self.slowest = []
+
+    def add_line(self, line):
+        pairs = {}
+        fields = self.fields
+        for key, quoted, bare in PAIR_RE.findall(line):
+            pairs[key] = quoted or bare
+            if bare and key not in HEADER_FIELDS:
+                try:
+                    value = float(bare)
+                except ValueError:
+                    continue
+                if not math.isfinite(value):
+                    # e.g. a float("nan") written as context, which can't be
+                    # bucketed.
+                    continue
+                histogram = fields.get(key)
+                if histogram is None:
+                    histogram = fields[key] = Histogram()
+                histogram.add(value)
+                if key == self.duration_field:
+                    self._add_duration(value, pairs.get(b"id", b"unknown"))
+        if not pairs:
+            return
+        self.lines += 1
+        if pairs.get(b"at") in ERROR_LEVELS:
+            self.errors_by_tag[pairs.get(b"tag", b"")] += 1
+            self.errors_by_module[pairs.get(b"module", b"")] += 1
+
+    def _add_duration(self, value, id_):
+        item = (value, id_)
+        if len(self.slowest) < self.top:
+            heapq.heappush(self.slowest, item)
+        elif item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def merge(self, other):
+        self.lines += other.lines
+        self.errors_by_tag.update(other.errors_by_tag)
+        self.errors_by_module.update(other.errors_by_module)
+        for key, histogram in other.fields.items():
+            if key in self.fields:
+                self.fields[key].merge(histogram)
+            else:
+                self.fields[key] = histogram
+        for item in other.slowest:
+            self._add_duration(*item)
+        return self
+
+    def report(self):
+        """Return the aggregates as plain, JSON-serializable data."""
+
+        def decode(value):
+            return value.decode("utf-8", "replace").replace('\\"', '"')
+
+        return {
+            "lines": self.lines,
+            "errors_by_tag": {
+                decode(k): n for k, n in self.errors_by_tag.most_common()
+            },
+            "errors_by_module": {
+                decode(k): n for k, n in self.errors_by_module.most_common()
+            },
+            "slowest": [
+                {"id": decode(id_), "duration": value}
+                for value, id_ in sorted(self.slowest, reverse=True)
+            ],
+            "fields": {
+                decode(key): {
+                    "count": histogram.count,
+                    "p50": histogram.percentile(50),
+                    "p95": histogram.percentile(95),
+                    "p99": histogram.percentile(99),
+                    "max": histogram.max,
+                }
+                for key, histogram in sorted(self.fields.items())
+            },
+        }
+
+
+def _mmap(path):
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _analyze_range(path, start, end, duration_field, top):
+    stats = LogStats(duration_field, top)
+    with _mmap(path) as mm:
+        position = start
+        while position < end:
+            newline = mm.find(b"\n", position, end)
+            if newline == -1:
+                newline = end
+            stats.add_line(mm[position:newline])
+            position = newline + 1
+    return stats
+
+
+def _analyze_lines(lines, duration_field, top):
+    stats = LogStats(duration_field, top)
+    for line in lines:
+        stats.add_line(line)
+    return stats
+
+
+def _chunk_offsets(path, chunk_size):
+    """Split the file into (start, end) ranges that end at line breaks."""
+    size = os.path.getsize(path)
+    if not size:
+        return []
+    offsets = []
+    with _mmap(path) as mm:
+        start = 0
+        while start < size:
+            end = mm.find(b"\n", min(start + chunk_size, size) - 1)
+            end = size if end == -1 else end + 1
+            offsets.append((start, end))
+            start = end
+    return offsets
+
+
+def _run(function, jobs, workers):
+    if workers == 1:
+        return [function(*args) for args in jobs]
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [executor.submit(function, *args) for args in jobs]
+        return [future.result() for future in futures]
+
+
+def analyze_file(
+    path,
+    workers=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    duration_field="duration_ms",
+    top=10,
+):
+    """Analyze a log file in parallel chunks, returning a LogStats."""
+    jobs = [
+        (path, start, end, duration_field, top)
+        for start, end in _chunk_offsets(path, chunk_size)
+    ]
+    stats = LogStats(duration_field, top)
+    for partial in _run(_analyze_range, jobs, workers):
+        stats.merge(partial)
+    return stats
+
+
+def analyze_stream(
+    stream,
+    workers=None,
+    batch_lines=STREAM_BATCH_LINES,
+    duration_field="duration_ms",
+    top=10,
+):
+    """
+    Analyze a binary stream such as stdin, returning a LogStats. Batches of
+    ``batch_lines`` lines are handed to the pool as they are read, with at
+    most two batches per worker in flight.
+    """
+    stats = LogStats(duration_field, top)
+    batches = iter(lambda: list(islice(stream, batch_lines)), [])
+    if workers == 1:
+        for batch in batches:
+            stats.merge(_analyze_lines(batch, duration_field, top))
+        return stats
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers) as executor:
+        in_flight = []
+        limit = 2 * workers
+        for batch in batches:
+            in_flight.append(
+                executor.submit(_analyze_lines, batch, duration_field, top)
+            )
+            if len(in_flight) >= limit:
+                stats.merge(in_flight.pop(0).result())
+        for future in in_flight:
+            stats.merge(future.result())
+    return stats
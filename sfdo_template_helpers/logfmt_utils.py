@@ -1,8 +1,26 @@
+import contextvars
+import copy
 import datetime
+import functools
 import io
+import json
 import logging
+import math
 import numbers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections.abc import Mapping
+from contextlib import contextmanager
 
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
 from django.utils.log import ServerFormatter
 from logfmt import parse
 
@@ -12,18 +30,440 @@ except ImportError:  # pragma: nocover
     def get_current_job(*args, **kwargs):
         pass
 
+try:
+    import orjson
+except ImportError:  # pragma: nocover
+    orjson = None
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:  # pragma: nocover
+    # asgiref before 3.6, or none at all before Django 3.0: mark middleware
+    # the way Django's own did until 4.1.
+    import asyncio
+
+    iscoroutinefunction = asyncio.iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+
 NO_JOB_ID = "no-job-id"
+# IDs we accept from the request header; anything else could inject fields
+# into the unquoted id= value.
+REQUEST_ID_RE = re.compile(r"^[a-zA-Z0-9._-]{1,200}$")
+
+# Set once per request or job, and read for every log record. Like all
+# context variables they follow the code into asyncio tasks and sync_to_async
+# calls; use copy_log_context for plain threads.
+request_id_var = contextvars.ContextVar("request_id", default=None)
+job_id_var = contextvars.ContextVar("job_id", default=None)
+# The _CanonicalLog collecting fields for the current request or job, if any.
+canonical_log_var = contextvars.ContextVar("canonical_log", default=None)
+
+logger = logging.getLogger(__name__)
 
 
 class JobIDFilter(logging.Filter):
     def filter(self, record):
-        if get_current_job():
-            record.job_id = get_current_job().id
-        else:
-            record.job_id = NO_JOB_ID
+        job_id = job_id_var.get()
+        if job_id is None:
+            # Not inside with_job_id, so ask RQ directly.
+            job = get_current_job()
+            job_id = job.id if job else NO_JOB_ID
+        record.job_id = job_id
+        request_id = request_id_var.get()
+        if request_id is not None:
+            record.request_id = request_id
         return True
 
 
+class _SamplingRule:
+    __slots__ = ("sample_rate", "rate", "burst", "tokens", "updated")
+
+    def __init__(self, sample_rate=1.0, rate=None, burst=None):
+        self.sample_rate = sample_rate
+        self.rate = rate
+        # The bucket must hold at least one whole token, or nothing passes.
+        self.burst = max(1, rate or 0) if burst is None else burst
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def allow(self, now):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        if self.rate is None:
+            return True
+        # Token bucket: refill at `rate` per second, up to `burst`.
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Samples and rate-limits records per tag and per level, so one noisy tag
+    can't flood the log drain. Configure it with the LOG_SAMPLING_RULES
+    setting (or a ``rules`` argument), like this:
+
+        LOG_SAMPLING_RULES = {
+            "tags": {
+                # Keep 10% of these, and at most 5 a second with bursts of 20:
+                "some tag": {"sample_rate": 0.1, "rate": 5, "burst": 20},
+            },
+            "levels": {
+                "DEBUG": {"sample_rate": 0.01},
+            },
+        }
+
+    A record is kept only if it passes both its tag's and its level's rule.
+    Records with no rule pass straight through. At most every
+    ``summary_interval`` seconds, the counts of suppressed records are
+    logged to the ``sfdo_template_helpers.logfmt_utils.sampling`` logger, so
+    route that logger to the same handler.
+    """
+
+    RULE_KEYS = {"sample_rate", "rate", "burst"}
+
+    def __init__(self, rules=None, summary_interval=60):
+        super().__init__()
+        if rules is None:
+            rules = getattr(settings, "LOG_SAMPLING_RULES", {})
+        self.tag_rules = self._build_rules(rules.get("tags", {}))
+        self.level_rules = self._build_rules(rules.get("levels", {}))
+        self.summary_interval = summary_interval
+        self._lock = threading.Lock()
+        self._suppressed = {}
+        self._last_summary = time.monotonic()
+
+    def _build_rules(self, rules):
+        built = {}
+        for name, rule in rules.items():
+            unknown = set(rule) - self.RULE_KEYS
+            if unknown:
+                raise ValueError(f"Unknown sampling options for {name}: {unknown}")
+            built[name] = _SamplingRule(**rule)
+        return built
+
+    def filter(self, record):
+        tag = getattr(record, "tag", None)
+        tag_rule = self.tag_rules.get(tag)
+        level_rule = self.level_rules.get(record.levelname)
+        if tag_rule is None and level_rule is None:
+            if self._suppressed:
+                self._maybe_log_summary()
+            return True
+
+        now = time.monotonic()
+        with self._lock:
+            allowed = (tag_rule is None or tag_rule.allow(now)) and (
+                level_rule is None or level_rule.allow(now)
+            )
+            if not allowed:
+                key = tag or record.levelname
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+        # Checked for suppressed records too, in case nothing else passes.
+        if self._suppressed:
+            self._maybe_log_summary()
+        return allowed
+
+    def _maybe_log_summary(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_summary < self.summary_interval:
+                return
+            suppressed, self._suppressed = self._suppressed, {}
+            self._last_summary = now
+        # Logged outside the lock, as this record passes through this filter.
+        logging.getLogger(f"{__name__}.sampling").warning(
+            "Suppressed log records",
+            extra={
+                "tag": "log-sampling",
+                "context": {
+                    "suppressed_total": sum(suppressed.values()),
+                    **{
+                        "suppressed." + re.sub(r"[^\w.-]", "_", key): n
+                        for key, n in suppressed.items()
+                    },
+                },
+            },
+        )
+
+
+class RequestIDMiddleware:
+    """
+    Sets the request ID for every log line written while handling a request.
+
+    The ID comes from the header named in the REQUEST_ID_HEADER setting
+    (default ``HTTP_X_REQUEST_ID``, which Heroku sets) or is generated, and is
+    also available as ``request.request_id``. Works in sync and async stacks.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def _get_request_id(self, request):
+        header = getattr(settings, "REQUEST_ID_HEADER", "HTTP_X_REQUEST_ID")
+        request_id = request.META.get(header, "")
+        if not REQUEST_ID_RE.match(request_id):
+            request_id = uuid.uuid4().hex
+        request.request_id = request_id
+        return request_id
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        token = request_id_var.set(self._get_request_id(request))
+        try:
+            return self.get_response(request)
+        finally:
+            request_id_var.reset(token)
+
+    async def __acall__(self, request):
+        token = request_id_var.set(self._get_request_id(request))
+        try:
+            return await self.get_response(request)
+        finally:
+            request_id_var.reset(token)
+
+
+def with_job_id(func):
+    """
+    Decorate an RQ job function to look up the job ID once, instead of for
+    every log record it writes.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        job = get_current_job()
+        token = job_id_var.set(job.id if job else NO_JOB_ID)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            job_id_var.reset(token)
+
+    return wrapper
+
+
+def copy_log_context(func):
+    """
+    Wrap ``func`` to run with the current request and job IDs, for handing
+    to a thread or executor.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # Copy again, as a context can only be entered by one thread at once.
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
+
+
+class _CanonicalLog:
+    def __init__(self, fields):
+        self.fields = fields
+        self.queries = 0
+        self.query_time = 0.0
+        self.start = time.perf_counter()
+
+
+def _record_query(execute, sql, params, many, context):
+    log = canonical_log_var.get()
+    if log is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        log.queries += 1
+        log.query_time += time.perf_counter() - start
+
+
+def _install_query_recorder(connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        # Outermost, as connection.execute_wrapper() pops the last wrapper
+        # when its block ends, which must be its own.
+        connection.execute_wrappers.insert(0, _record_query)
+
+
+_query_recorder_connected = False
+
+
+def _connect_query_recorder():
+    # Connected on first use, rather than on import, so projects that only use
+    # the formatter don't wrap every query. Connections are per thread, so
+    # this also covers the threads sync_to_async runs queries in.
+    global _query_recorder_connected
+    if not _query_recorder_connected:
+        connection_created.connect(_install_query_recorder)
+        _query_recorder_connected = True
+
+
+@contextmanager
+def canonical_log_line(message, tag="canonical", **fields):
+    """
+    Collect fields for the enclosed unit of work and log them as one line
+    when it ends, with its duration and the number and duration of its
+    database queries. Yields the dict of fields, which add_log_context and
+    CanonicalLogFilter also add to.
+    """
+    _connect_query_recorder()
+    for connection in connections.all():
+        _install_query_recorder(connection)
+    log = _CanonicalLog(fields)
+    token = canonical_log_var.set(log)
+    try:
+        yield log.fields
+    finally:
+        canonical_log_var.reset(token)
+        logger.info(
+            message,
+            extra={
+                "tag": tag,
+                "context": {
+                    **log.fields,
+                    "duration_ms": round((time.perf_counter() - log.start) * 1000, 2),
+                    "db_queries": log.queries,
+                    "db_time_ms": round(log.query_time * 1000, 2),
+                },
+            },
+        )
+
+
+def add_log_context(**fields):
+    """
+    Add fields to the current canonical log line. Returns False, doing
+    nothing, outside of one.
+    """
+    log = canonical_log_var.get()
+    if log is None:
+        return False
+    log.fields.update(fields)
+    return True
+
+
+class CanonicalLogFilter(logging.Filter):
+    """
+    Folds the ``context`` of records below ``level`` (WARNING by default)
+    into the current canonical log line instead of writing them, so a request
+    emits one line. Records at or above ``level``, and records outside a
+    request or job, pass through as usual.
+    """
+
+    def __init__(self, name="", level=logging.WARNING):
+        super().__init__(name)
+        self.level = level if isinstance(level, int) else logging.getLevelName(level)
+
+    def filter(self, record):
+        log = canonical_log_var.get()
+        if log is None or record.levelno >= self.level:
+            return True
+        log.fields.update(getattr(record, "context", None) or {})
+        return False
+
+
+class CanonicalLogMiddleware:
+    """
+    Logs one canonical line per request, with the method, path, status,
+    duration, database query count and time, and any fields collected with
+    add_log_context or CanonicalLogFilter. Works in sync and async stacks.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+        # Before any request, so it covers every connection that's opened.
+        _connect_query_recorder()
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        with canonical_log_line(
+            "Request finished", method=request.method, path=request.path
+        ) as fields:
+            fields["status"] = 500  # Unless we get a response.
+            response = self.get_response(request)
+            fields["status"] = response.status_code
+        return response
+
+    async def __acall__(self, request):
+        with canonical_log_line(
+            "Request finished", method=request.method, path=request.path
+        ) as fields:
+            fields["status"] = 500  # Unless we get a response.
+            response = await self.get_response(request)
+            fields["status"] = response.status_code
+        return response
+
+
+class RequestLoggingMiddleware:
+    """
+    Logs each request's method, path, status and duration as a dict message,
+    which LogfmtFormatter writes as fields without re-parsing. Works in sync
+    and async stacks.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def _log(self, request, response, start):
+        logger.info(
+            {
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "time_ms": round((time.perf_counter() - start) * 1000, 2),
+            },
+            extra={"tag": "request"},
+        )
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self._log(request, response, start)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self._log(request, response, start)
+        return response
+
+
+def with_canonical_log(func):
+    """
+    Decorate an RQ job function to log one canonical line for the job.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with canonical_log_line("Job finished", job=func.__qualname__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
 class LogfmtFormatter(ServerFormatter):
     """
     To use this logger to its fullest extent, log lines like this:
@@ -37,36 +477,141 @@ class LogfmtFormatter(ServerFormatter):
                 },
             },
         )
+
+    Or, to log fields in place of a message, log a dict:
+
+        logger.info({"method": "GET", "path": "/", "status": 200})
+
+    Messages from a module called ``logging_middleware`` are still parsed as
+    logfmt and their fields emitted, for loggers that predate dict messages.
+
+    Nested dicts, lists and tuples are flattened into dot-path keys, so
+    ``{"org": {"id": 1}}`` is written as ``org.id=1``, down to ``max_depth``
+    levels; anything deeper is written with str().
     """
 
+    max_depth = 3
+    # Bounds the key path cache, both the prefixes and the keys per prefix,
+    # in case keys are unbounded, e.g. IDs.
+    max_key_paths = 256
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (whole second, formatted time up to the microseconds) of the last
+        # record, since consecutive records almost always share the second.
+        self._time_cache = (None, None)
+        # Encoders by exact type; other types are resolved once and added.
+        self._encoders = {
+            type(None): self._encode_none,
+            bool: self._encode_bool,
+            int: self._encode_number,
+            float: self._encode_number,
+            str: self._encode_str,
+            dict: self._encode_mapping,
+            list: self._encode_sequence,
+            tuple: self._encode_sequence,
+        }
+        self._key_paths = {}
+
     def _parse_msg(self, msg):
         msg = list(parse(io.StringIO(msg)))
         return msg[0]
 
     def _escape_quotes(self, string):
-        return '"{}"'.format(string.replace('"', "\\" + '"'))
+        # str.replace beats a str.translate table here, as there's only one
+        # character to escape.
+        return '"' + string.replace('"', '\\"') + '"'
+
+    def _encode_none(self, out, key, value, depth):
+        out.append(f"{key}=")
+
+    def _encode_bool(self, out, key, value, depth):
+        out.append(f"{key}=true" if value else f"{key}=false")
+
+    def _encode_number(self, out, key, value, depth):
+        out.append(f"{key}={value}")  # Numbers can be interpolated as-is.
+
+    def _encode_str(self, out, key, value, depth):
+        out.append(f"{key}=" + self._escape_quotes(value))
+
+    def _encode_other(self, out, key, value, depth):
+        out.append(f"{key}=" + self._escape_quotes(str(value)))
+
+    def _encode_mapping(self, out, key, value, depth):
+        if value and depth < self.max_depth:
+            self._format_items(out, value.items(), key, depth + 1)
+        else:
+            self._encode_other(out, key, value, depth)
+
+    def _encode_sequence(self, out, key, value, depth):
+        if value and depth < self.max_depth:
+            self._format_items(out, enumerate(value), key, depth + 1)
+        else:
+            self._encode_other(out, key, value, depth)
+
+    def _resolve_encoder(self, value_type):
+        # A str subclass may override __str__, so it isn't given the fast
+        # path for exact strs.
+        if issubclass(value_type, numbers.Number):
+            encoder = self._encode_number
+        elif issubclass(value_type, Mapping):
+            encoder = self._encode_mapping
+        elif issubclass(value_type, (list, tuple)):
+            encoder = self._encode_sequence
+        else:
+            encoder = self._encode_other
+        self._encoders[value_type] = encoder
+        return encoder
+
+    def _format_items(self, out, items, prefix, depth):
+        encoders = self._encoders
+        if prefix is None:
+            for k, v in items:
+                encoder = encoders.get(type(v)) or self._resolve_encoder(type(v))
+                encoder(out, k, v, depth)
+            return
+        # {key: "prefix.key"} for this prefix. Keys other than strings are
+        # cached with their type, as True, 1 and 1.0 are equal but print
+        # differently.
+        prefix_key = prefix if type(prefix) is str else (type(prefix), prefix)
+        paths = self._key_paths.get(prefix_key)
+        if paths is None:
+            if len(self._key_paths) >= self.max_key_paths:
+                self._key_paths.clear()
+            paths = self._key_paths[prefix_key] = {}
+        for k, v in items:
+            cache_key = k if type(k) is str else (type(k), k)
+            path = paths.get(cache_key)
+            if path is None:
+                if len(paths) >= self.max_key_paths:
+                    paths.clear()
+                path = paths[cache_key] = f"{prefix}.{k}"
+            encoder = encoders.get(type(v)) or self._resolve_encoder(type(v))
+            encoder(out, path, v, depth)
 
     def format_line(self, extra):
         out = []
-        for k, v in extra.items():
-            if v is None:
-                v = ""
-            elif isinstance(v, bool):
-                v = "true" if v else "false"
-            elif isinstance(v, numbers.Number):
-                pass  # v can be string-interpolated as-is.
-            else:
-                v = str(v)
-                v = self._escape_quotes(v)
-            out.append("{}={}".format(k, v))
+        self._format_items(out, extra.items(), None, 0)
         return " ".join(out)
 
-    def _get_time(self, record):
-        return self._escape_quotes(
-            datetime.datetime.fromtimestamp(record.created).strftime(
-                "%Y-%m-%d %H:%M:%S.%f"
+    def _get_timestamp(self, record):
+        # Split the timestamp the way datetime.fromtimestamp does, rounding
+        # the microseconds half-to-even, so the output is identical.
+        fraction, second = math.modf(record.created)
+        microsecond = round(fraction * 1e6)
+        if microsecond >= 1000000:
+            second += 1
+            microsecond -= 1000000
+        cached_second, prefix = self._time_cache
+        if second != cached_second:
+            prefix = datetime.datetime.fromtimestamp(second).strftime(
+                "%Y-%m-%d %H:%M:%S."
             )
-        )
+            self._time_cache = (second, prefix)
+        return f"{prefix}{microsecond:06d}"
+
+    def _get_time(self, record):
+        return f'"{self._get_timestamp(record)}"'
 
     def _get_id(self, record):
         return (
@@ -82,26 +627,245 @@ class LogfmtFormatter(ServerFormatter):
         return "external"
 
     def format(self, record):
-        parsed_msg = record.module == "logging_middleware"
-        id_ = self._get_id(record)
-        time = self._get_time(record)
-        tag = self._get_tag(record)
-        if parsed_msg:
-            msg = self._parse_msg(record.getMessage())
+        module = record.module
+        line = (
+            f"id={self._get_id(record)} at={record.levelname} "
+            f"time={self._get_time(record)} tag={self._get_tag(record)} "
+            f"module={module}"
+        )
+        msg = record.msg
+        if not isinstance(msg, str) and isinstance(msg, Mapping):
+            if msg:
+                line += " " + self.format_line(msg)
+        elif module == "logging_middleware":
+            for k, v in self._parse_msg(record.getMessage()).items():
+                line += f" {k}={v}"
         else:
-            msg = self._escape_quotes(record.getMessage())
-        rest = self.format_line(getattr(record, "context", {}))
-        fields = [
-            f"id={id_}",
-            f"at={record.levelname}",
-            f"time={time}",
-            f"tag={tag}",
-            f"module={record.module}",
-        ]
-        if parsed_msg:
-            for k, v in msg.items():
-                fields.append(f"{k}={v}")
+            line += " msg=" + self._escape_quotes(record.getMessage())
+        context = getattr(record, "context", None)
+        if context:
+            line += " " + self.format_line(context)
+        return line
+
+
+def _jsonable(value):
+    # What orjson writes for values the json module can't: null for NaN and
+    # infinity, and keys other than strings and numbers with str().
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, Mapping):
+        return {
+            (k if isinstance(k, (str, int)) or k is None else str(k)): _jsonable(v)
+            for k, v in value.items()
+        }
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+class JSONLinesFormatter(LogfmtFormatter):
+    """
+    Formats records as one JSON object per line, for sinks that ingest JSON
+    faster than logfmt. The fields are the same as LogfmtFormatter's: id, at,
+    time, tag and module, then msg or the fields of a dict message, then the
+    context. A message field that would replace an earlier one is written as
+    ``msg.<key>``, and a context field as ``context.<key>``, where logfmt
+    would write the key twice. Values JSON can't represent are written with
+    str(), except NaN and infinity, which are written as null, and so are
+    keys other than strings and numbers.
+
+    Encodes with orjson when it's installed, and the json module otherwise.
+    """
+
+    def _dumps(self, data):
+        if orjson is not None:
+            try:
+                return orjson.dumps(
+                    data,
+                    default=str,
+                    option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+                ).decode("utf-8")
+            except orjson.JSONEncodeError:
+                pass  # E.g. an int over 64 bits; json can encode those.
+        try:
+            return self._json_dumps(data)
+        except (TypeError, ValueError):
+            return self._json_dumps(_jsonable(data))
+
+    def _json_dumps(self, data):
+        return json.dumps(
+            data,
+            default=str,
+            ensure_ascii=False,
+            allow_nan=False,
+            separators=(",", ":"),
+        )
+
+    @staticmethod
+    def _add_fields(data, fields, namespace):
+        for key, value in fields.items():
+            if key in data:
+                key = f"{namespace}.{key}"
+            data.setdefault(key, value)
+
+    def format(self, record):
+        data = {
+            "id": self._get_id(record),
+            "at": record.levelname,
+            "time": self._get_timestamp(record),
+            "tag": getattr(record, "tag", None) or "external",
+            "module": record.module,
+        }
+        msg = record.msg
+        if not isinstance(msg, str) and isinstance(msg, Mapping):
+            self._add_fields(data, msg, "msg")
+        elif record.module == "logging_middleware":
+            self._add_fields(data, self._parse_msg(record.getMessage()), "msg")
         else:
-            fields.append(f"msg={msg}")
-        fields.append(f"{rest}")
-        return " ".join(filter(None, fields))
+            data["msg"] = record.getMessage()
+        context = getattr(record, "context", None)
+        if context:
+            self._add_fields(data, context, "context")
+        return self._dumps(data)
+
+
+_STOP = object()
+
+
+class QueuedLogfmtHandler(logging.Handler):
+    """
+    A handler that only enqueues records on the logging thread, and formats
+    and writes them in batches on a background thread, so a slow stream
+    doesn't add to request latency. Set it up like a StreamHandler:
+
+        "handlers": {
+            "console": {
+                "class": "sfdo_template_helpers.logfmt_utils.QueuedLogfmtHandler",
+                "filters": ["job_id"],
+                "formatter": "logfmt",
+                "queue_size": 10000,
+                "policy": "drop",
+            },
+        },
+
+    When the queue is full, the "drop" policy drops the record and counts it,
+    and the "block" policy waits up to ``block_timeout`` seconds (forever if
+    None) for room before dropping it. ``stats()`` reports the queue depth
+    and counters. Records still queued are written when the handler is
+    flushed or closed, which ``logging.shutdown`` does at exit.
+    """
+
+    POLICIES = ("drop", "block")
+
+    def __init__(
+        self,
+        stream=None,
+        queue_size=10000,
+        policy="drop",
+        block_timeout=None,
+        batch_size=100,
+    ):
+        super().__init__()
+        if policy not in self.POLICIES:
+            raise ValueError(f"policy must be one of {self.POLICIES}, not {policy!r}")
+        self.stream = stream or sys.stderr
+        self.queue_size = queue_size
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self.formatter = LogfmtFormatter()
+        self.dropped = 0
+        self.written = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def _start(self):
+        # Also called after a fork, as the writer thread doesn't survive it.
+        self._pid = os.getpid()
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = threading.Thread(
+            target=self._run, args=(self._queue,), daemon=True
+        )
+        self._thread.start()
+
+    def prepare(self, record):
+        """
+        Snapshot the parts of the record a caller might change after logging,
+        as QueueHandler.prepare does, since it's formatted later.
+        """
+        record = copy.copy(record)
+        if record.args:
+            record.msg = record.getMessage()
+            record.args = None
+        elif isinstance(record.msg, Mapping):
+            record.msg = dict(record.msg)
+        context = getattr(record, "context", None)
+        if isinstance(context, Mapping):
+            record.context = dict(context)
+        return record
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            record = self.prepare(record)
+        except Exception:
+            self.handleError(record)
+            return
+        try:
+            if self.policy == "block":
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1  # Handler.handle holds self.lock around emit.
+
+    def _run(self, records):
+        while True:
+            batch = [records.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(records.get_nowait())
+                except queue.Empty:
+                    break
+            self._write([record for record in batch if record is not _STOP])
+            for _ in batch:
+                records.task_done()
+            if any(record is _STOP for record in batch):
+                return
+
+    def _write(self, batch):
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+        if not lines:
+            return
+        try:
+            self.stream.write("\n".join(lines) + "\n")
+            self.stream.flush()
+        except Exception:
+            self.handleError(batch[-1])
+        else:
+            self.written += len(lines)
+
+    def stats(self):
+        return {
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "dropped": self.dropped,
+            "written": self.written,
+        }
+
+    def flush(self):
+        """Wait until every queued record has been written."""
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+        super().close()
@@ -0,0 +1,91 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+
+from sfdo_template_helpers.logfmt_analysis import (
+    DEFAULT_CHUNK_SIZE,
+    LogStats,
+    analyze_file,
+    analyze_stream,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Summarize LogfmtFormatter logs: error counts by tag and module, the "
+        "slowest request IDs and percentiles of numeric fields."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "paths", nargs="*", default=["-"], help="Log files, or - for stdin."
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            help="Processes to parse with (default: one per CPU).",
+        )
+        parser.add_argument(
+            "--chunk-size",
+            type=int,
+            default=DEFAULT_CHUNK_SIZE,
+            help="Bytes of a file to hand to each process at a time.",
+        )
+        parser.add_argument(
+            "--duration-field",
+            default="duration_ms",
+            help="The field to rank the slowest requests by.",
+        )
+        parser.add_argument(
+            "--top", type=int, default=10, help="How many slowest IDs to show."
+        )
+        parser.add_argument("--json", action="store_true", help="Output JSON.")
+
+    def handle(self, paths, workers, chunk_size, duration_field, top, **options):
+        stats = LogStats(duration_field, top)
+        for path in paths:
+            if path == "-":
+                stats.merge(
+                    analyze_stream(
+                        sys.stdin.buffer,
+                        workers=workers,
+                        duration_field=duration_field,
+                        top=top,
+                    )
+                )
+            else:
+                stats.merge(
+                    analyze_file(
+                        path,
+                        workers=workers,
+                        chunk_size=chunk_size,
+                        duration_field=duration_field,
+                        top=top,
+                    )
+                )
+        report = stats.report()
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self._write_report(report, duration_field)
+
+    def _write_report(self, report, duration_field):
+        self.stdout.write(f"Lines: {report['lines']}")
+        for title, key in (("tag", "errors_by_tag"), ("module", "errors_by_module")):
+            self.stdout.write(f"\nErrors by {title}:")
+            for name, count in report[key].items():
+                self.stdout.write(f"  {count:>8}  {name or '-'}")
+        self.stdout.write(f"\nSlowest by {duration_field}:")
+        for item in report["slowest"]:
+            self.stdout.write(f"  {item['duration']:>12g}  {item['id']}")
+        self.stdout.write("\nFields:")
+        self.stdout.write(
+            f"  {'field':<24} {'count':>8} {'p50':>12} {'p95':>12} {'p99':>12} "
+            f"{'max':>12}"
+        )
+        for name, field in report["fields"].items():
+            self.stdout.write(
+                f"  {name:<24} {field['count']:>8} {field['p50']:>12.4g} "
+                f"{field['p95']:>12.4g} {field['p99']:>12.4g} {field['max']:>12.4g}"
+            )
@@ -0,0 +1,55 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from sfdo_template_helpers.slugs import SlugMixin
+
+
+class Command(BaseCommand):
+    help = (
+        "Create missing slugs for a SlugMixin model, and optionally deactivate "
+        "all but the newest of several active slugs, in batched transactions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The model, as app_label.ModelName.")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="How many rows to repair per transaction.",
+        )
+        parser.add_argument(
+            "--start-after",
+            help="Resume after this primary key, as reported by an earlier run.",
+        )
+        parser.add_argument(
+            "--deactivate-old-slugs",
+            action="store_true",
+            help=(
+                "Deactivate all but the newest active slug of each row. Old "
+                "slugs will no longer resolve."
+            ),
+        )
+
+    def handle(self, model, batch_size, start_after, deactivate_old_slugs, **options):
+        try:
+            model_class = apps.get_model(model)
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        if not issubclass(model_class, SlugMixin):
+            raise CommandError(f"{model} does not use SlugMixin.")
+
+        rows = created = deactivated = 0
+        for progress in model_class.repair_slugs(
+            batch_size=batch_size,
+            start_after=start_after,
+            deactivate_old=deactivate_old_slugs,
+        ):
+            rows += progress.rows
+            created += progress.created
+            deactivated += progress.deactivated
+            self.stdout.write(
+                f"Processed {rows} rows up to pk {progress.last_pk}: "
+                f"created {created} slugs, deactivated {deactivated} slugs."
+            )
+        self.stdout.write(f"Done. Processed {rows} {model} rows.")
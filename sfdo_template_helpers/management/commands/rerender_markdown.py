@@ -0,0 +1,67 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from sfdo_template_helpers.fields.markdown import MarkdownFieldMixin
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-render the stored HTML of a model's MarkdownField(store_html=True) "
+        "fields, e.g. after changing allowed_tags or allowed_attrs, in batched "
+        "transactions."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The model, as app_label.ModelName.")
+        parser.add_argument(
+            "--field",
+            action="append",
+            dest="fields",
+            help="A field to re-render. Defaults to every field that stores HTML.",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="How many rows to re-render per transaction.",
+        )
+        parser.add_argument(
+            "--start-after",
+            help="Resume after this primary key, as reported by an earlier run.",
+        )
+
+    def handle(self, model, fields, batch_size, start_after, **options):
+        try:
+            model_class = apps.get_model(model)
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        stored = [
+            field
+            for field in model_class._meta.get_fields()
+            if isinstance(field, MarkdownFieldMixin) and field.store_html
+        ]
+        if fields:
+            unknown = set(fields) - {field.name for field in stored}
+            if unknown:
+                raise CommandError(
+                    f"{model} has no MarkdownField with store_html=True named "
+                    f"{', '.join(sorted(unknown))}."
+                )
+            stored = [field for field in stored if field.name in fields]
+        if not stored:
+            raise CommandError(f"{model} has no MarkdownField with store_html=True.")
+
+        for field in stored:
+            rows = updated = 0
+            for progress in field.rerender(
+                batch_size=batch_size, start_after=start_after
+            ):
+                rows += progress.rows
+                updated += progress.updated
+                self.stdout.write(
+                    f"{field.name}: processed {rows} rows up to pk "
+                    f"{progress.last_pk}, updated {updated}."
+                )
+            self.stdout.write(
+                f"Done. Updated {updated} of {rows} {model} rows for {field.name}."
+            )
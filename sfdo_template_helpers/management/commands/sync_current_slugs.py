@@ -0,0 +1,37 @@
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = (
+        "Backfill or verify the denormalized current_slug_field of a "
+        "SlugMixin model against its slug table."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", help="The model, as app_label.ModelName.")
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="How many rows to check per query.",
+        )
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Only report rows that are out of sync, and fail if any are.",
+        )
+
+    def handle(self, model, batch_size, check, **options):
+        try:
+            model_class = apps.get_model(model)
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+        if not getattr(model_class, "current_slug_field", None):
+            raise CommandError(f"{model} does not set current_slug_field.")
+
+        stale = model_class.sync_current_slugs(batch_size=batch_size, fix=not check)
+        if check and stale:
+            raise CommandError(f"{stale} {model} rows have an out-of-date slug.")
+        verb = "are" if check else "were"
+        self.stdout.write(f"{stale} {model} rows {verb} out of sync.")
@@ -1,3 +1,6 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest import mock
 
 import pytest
@@ -5,13 +8,136 @@ import requests
 from allauth.socialaccount.models import SocialApp
 from django.core.exceptions import SuspiciousOperation
 from sfdo_template_helpers.crypto import fernet_decrypt, fernet_encrypt
+from sfdo_template_helpers.logfmt_utils import request_id_var
 
 from ..views import (
     SalesforceOAuth2Adapter,
     SalesforcePermissionsError,
+    _get,
+    get_session,
 )
 
 
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # For keep-alive.
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append((self.client_address, self.path))
+        status = server.statuses.pop(0) if server.statuses else 200
+        body = json.dumps({"path": self.path}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Set-Cookie", "sid=secret; Path=/")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server(settings):
+    settings.SOCIALACCOUNT_SALESFORCE_BACKOFF_FACTOR = 0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.requests = []
+    server.statuses = []
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    get_session().close()
+    server.shutdown()
+    server.server_close()
+
+
+USERINFO = {
+    "organization_id": "00D000000000001EAA",
+    "user_id": "003000000000001",
+    "preferred_username": "test@example.com",
+    "language": "en_US",
+    "urls": {
+        "rest": "https://example.com/services/data/v{version}/",
+        "sobjects": "https://example.com/services/data/v{version}/sobjects/",
+    },
+}
+
+
+def route_get(mocker, permissions=None, org=None):
+    """
+    Patch the session to answer by URL, as get_org_details sends its requests
+    from more than one thread, in no particular order.
+    """
+    userinfo = mock.MagicMock()
+    userinfo.json.return_value = USERINFO
+    routes = {
+        "/services/oauth2/userinfo": userinfo,
+        "/connect/organization": permissions or mock.MagicMock(),
+        "/sobjects/Organization/": org or mock.MagicMock(),
+    }
+
+    def get(url, **kwargs):
+        return next(resp for path, resp in routes.items() if path in url)
+
+    return mocker.patch("requests.Session.get", side_effect=get)
+
+
+class TestSession:
+    def test_keep_alive(self, stub_server):
+        assert _get(stub_server.url + "/a").json() == {"path": "/a"}
+        assert _get(stub_server.url + "/b").json() == {"path": "/b"}
+        (first, _), (second, _) = stub_server.requests
+        assert first == second  # The same connection.
+
+    def test_shared(self):
+        assert get_session() is get_session()
+
+    def test_rebuilt_when_settings_change(self, settings):
+        session = get_session()
+        settings.SOCIALACCOUNT_SALESFORCE_POOL_SIZE = 20
+        assert get_session() is not session
+        assert get_session().get_adapter("https://x")._pool_maxsize == 20
+
+    def test_retries_server_errors(self, stub_server):
+        stub_server.statuses = [503, 502]
+        assert _get(stub_server.url + "/a").status_code == 200
+        assert len(stub_server.requests) == 3
+
+    def test_retries_exhausted(self, stub_server, settings):
+        settings.SOCIALACCOUNT_SALESFORCE_RETRIES = 1
+        stub_server.statuses = [500, 500, 500]
+        resp = _get(stub_server.url + "/a")
+        assert resp.status_code == 500
+        assert len(stub_server.requests) == 2
+        with pytest.raises(requests.HTTPError):
+            resp.raise_for_status()
+
+    def test_client_errors_not_retried(self, stub_server):
+        stub_server.statuses = [403]
+        assert _get(stub_server.url + "/a").status_code == 403
+        assert len(stub_server.requests) == 1
+
+    def test_connection_errors_retried(self, settings):
+        settings.SOCIALACCOUNT_SALESFORCE_BACKOFF_FACTOR = 0
+        settings.SOCIALACCOUNT_SALESFORCE_RETRIES = 1
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        port = server.server_port
+        server.server_close()  # Nothing listening.
+        with pytest.raises(requests.ConnectionError, match="Max retries"):
+            _get(f"http://127.0.0.1:{port}/a")
+
+    def test_no_cookies(self, stub_server):
+        _get(stub_server.url + "/a")
+        assert not get_session().cookies
+
+    def test_timeout(self, mocker, settings):
+        settings.SOCIALACCOUNT_SALESFORCE_TIMEOUT = 5
+        get = mocker.patch("requests.Session.get")
+        _get("https://example.com")
+        get.assert_called_once_with("https://example.com", timeout=5)
+
+
 class TestSalesforceOAuth2Adapter:
     def test_base_url(self, rf):
         request = rf.post("/")
@@ -39,16 +165,7 @@ class TestSalesforceOAuth2Adapter:
 
     @pytest.mark.django_db
     def test_complete_login(self, mocker, rf):
-        get = mocker.patch("requests.get")
-        userinfo_mock = mock.MagicMock()
-        userinfo_mock.json.return_value = {
-            "organization_id": "00D000000000001EAA",
-            "user_id": "003000000000001",
-            "preferred_username": "test@example.com",
-            "language": "en_US",
-            "urls": mock.MagicMock(),
-        }
-        get.side_effect = [userinfo_mock, mock.MagicMock(), mock.MagicMock()]
+        route_get(mocker)
         request = rf.post("/")
         request.session = {"socialaccount_state": (None, "some-verifier")}
         adapter = SalesforceOAuth2Adapter(request)
@@ -67,14 +184,11 @@ class TestSalesforceOAuth2Adapter:
         assert ret.account.extra_data["instance_url"] == "https://example.com"
 
     def test_complete_login__no_modify_all_data_perm(self, rf, mocker):
-        bad_response = mock.MagicMock()
-        bad_response.raise_for_status.side_effect = requests.HTTPError
-        get = mocker.patch("requests.get")
         insufficient_perms_mock = mock.MagicMock()
         insufficient_perms_mock.json.return_value = {
             "userSettings": {"canModifyAllData": False}
         }
-        get.side_effect = [mock.MagicMock(), insufficient_perms_mock]
+        route_get(mocker, permissions=insufficient_perms_mock)
         request = rf.post("/")
         request.session = {"socialaccount_state": (None, "some-verifier")}
         adapter = SalesforceOAuth2Adapter(request)
@@ -91,15 +205,6 @@ class TestSalesforceOAuth2Adapter:
             adapter.complete_login(request, None, token, response={})
 
     def test_complete_login__api_disabled_for_org(self, rf, mocker):
-        get = mocker.patch("requests.get")
-        userinfo_mock = mock.MagicMock()
-        userinfo_mock.json.return_value = {
-            "organization_id": "00D000000000001EAA",
-            "user_id": "003000000000001",
-            "preferred_username": "test@example.com",
-            "language": "en_US",
-            "urls": mock.MagicMock(),
-        }
         api_disabled_mock = mock.MagicMock(status_code=403)
         api_disabled_mock.json.return_value = [
             {
@@ -108,7 +213,7 @@ class TestSalesforceOAuth2Adapter:
             }
         ]
 
-        get.side_effect = [userinfo_mock, mock.MagicMock(), api_disabled_mock]
+        route_get(mocker, org=api_disabled_mock)
         request = rf.post("/")
         request.session = {"socialaccount_state": (None, "some-verifier")}
         adapter = SalesforceOAuth2Adapter(request)
@@ -125,14 +230,11 @@ class TestSalesforceOAuth2Adapter:
             adapter.complete_login(request, None, token, response={})
 
     def test_complete_login__org_info_not_required(self, rf, mocker):
-        bad_response = mock.MagicMock()
-        bad_response.raise_for_status.side_effect = requests.HTTPError
-        get = mocker.patch("requests.get")
         insufficient_perms_mock = mock.MagicMock()
         insufficient_perms_mock.json.return_value = {
             "userSettings": {"canModifyAllData": False}
         }
-        get.side_effect = [mock.MagicMock(), insufficient_perms_mock]
+        route_get(mocker, permissions=insufficient_perms_mock)
         request = rf.post("/")
         request.session = {"socialaccount_state": (None, "some-verifier")}
         adapter = SalesforceOAuth2Adapter(request)
@@ -165,3 +267,80 @@ class TestSalesforceOAuth2Adapter:
         adapter = SalesforceOAuth2Adapter(request)
         with pytest.raises(SuspiciousOperation):
             adapter._validate_org_id("bogus")
+
+
+class TestGetOrgDetails:
+    def get_org_details(self, rf, org_id="00D000000000001EAA"):
+        adapter = SalesforceOAuth2Adapter(rf.post("/"))
+        return adapter.get_org_details(USERINFO["urls"], org_id, "token")
+
+    def test_concurrent(self, rf, mocker):
+        # Each request waits for the other to be sent, so this times out
+        # unless they're in flight together.
+        barrier = threading.Barrier(2, timeout=5)
+        permissions = mock.MagicMock()
+        permissions.json.return_value = {"userSettings": {"canModifyAllData": True}}
+        org = mock.MagicMock(status_code=200)
+        org.json.return_value = {"Name": "Org"}
+
+        def get(url, **kwargs):
+            barrier.wait()
+            return permissions if "/connect/organization" in url else org
+
+        get = mocker.patch("requests.Session.get", side_effect=get)
+        assert self.get_org_details(rf) == {"Name": "Org"}
+        assert get.call_count == 2
+
+    def test_permission_check_fails_fast(self, rf, mocker):
+        released = threading.Event()
+        permissions = mock.MagicMock()
+        permissions.json.return_value = {"userSettings": {"canModifyAllData": False}}
+
+        def get(url, **kwargs):
+            if "/connect/organization" in url:
+                return permissions
+            released.wait(5)  # Never answered while the check runs.
+            return mock.MagicMock()
+
+        mocker.patch("requests.Session.get", side_effect=get)
+        try:
+            with pytest.raises(SalesforcePermissionsError):
+                self.get_org_details(rf)
+        finally:
+            released.set()
+
+    def test_log_context(self, rf, mocker):
+        permissions = mock.MagicMock()
+        permissions.json.return_value = {"userSettings": {"canModifyAllData": True}}
+        seen = []
+
+        def get(url, **kwargs):
+            if "/connect/organization" in url:
+                return permissions
+            seen.append(request_id_var.get())
+            return mock.MagicMock(status_code=200)
+
+        mocker.patch("requests.Session.get", side_effect=get)
+        token = request_id_var.set("abc")
+        try:
+            self.get_org_details(rf)
+        finally:
+            request_id_var.reset(token)
+        # The org request's log lines carry the caller's request id.
+        assert seen == ["abc"]
+
+    def test_permission_request_fails(self, rf, mocker):
+        permissions = mock.MagicMock()
+        permissions.raise_for_status.side_effect = requests.HTTPError
+        route_get(mocker, permissions=permissions)
+        with pytest.raises(requests.HTTPError):
+            self.get_org_details(rf)
+
+    def test_invalid_org_id(self, rf, mocker):
+        get = route_get(mocker)
+        with pytest.raises(SuspiciousOperation):
+            self.get_org_details(rf, org_id="bogus")
+        # The org isn't requested with an invalid id.
+        (url,), _ = get.call_args
+        assert url.endswith("/connect/organization")
+        assert get.call_count == 1
@@ -1,5 +1,9 @@
 import logging
+import os
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
 
 import requests
 from allauth.socialaccount import providers
@@ -13,13 +17,75 @@ from allauth.socialaccount.providers.salesforce.views import (
 )
 from django.core.exceptions import SuspiciousOperation
 from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from sfdo_template_helpers.crypto import fernet_decrypt, fernet_encrypt
+from sfdo_template_helpers.logfmt_utils import copy_log_context
 
 logger = logging.getLogger(__name__)
 ORGID_RE = re.compile(r"^00D[a-zA-Z0-9]{15}$")
 CUSTOM_DOMAIN_RE = re.compile(r"^[a-zA-Z0-9.-]+$")
 ORGANIZATION_DETAILS = "organization_details"
+RETRY_STATUSES = (500, 502, 503, 504)
+
+_session_lock = threading.Lock()
+_session = None
+# The (pid, settings) the session was made for.
+_session_key = None
+
+
+def _session_settings():
+    return (
+        getattr(settings, "SOCIALACCOUNT_SALESFORCE_POOL_HOSTS", 10),
+        getattr(settings, "SOCIALACCOUNT_SALESFORCE_POOL_SIZE", 10),
+        getattr(settings, "SOCIALACCOUNT_SALESFORCE_RETRIES", 2),
+        getattr(settings, "SOCIALACCOUNT_SALESFORCE_BACKOFF_FACTOR", 0.2),
+    )
+
+
+def get_session():
+    """
+    Return the requests Session shared by callouts to Salesforce, which keeps
+    connections to each host alive for the next login, and retries GETs on
+    connection errors and 5xx responses with exponential backoff.
+
+    The session is made once per process, and again if its settings change.
+    It never stores cookies, so nothing carries over between users.
+    """
+    global _session, _session_key
+    config = _session_settings()
+    key = (os.getpid(), config)
+    if _session_key == key:
+        return _session
+    with _session_lock:
+        if _session_key != key:  # pragma: no branch
+            pool_hosts, pool_size, retries, backoff_factor = config
+            retry = Retry(
+                total=retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=["GET"],
+                # Hand the last response back, for raise_for_status:
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=retry
+            )
+            session = requests.Session()
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+            _session_key = key
+        return _session
+
+
+def _get(url, **kwargs):
+    kwargs.setdefault(
+        "timeout", getattr(settings, "SOCIALACCOUNT_SALESFORCE_TIMEOUT", 30)
+    )
+    return get_session().get(url, **kwargs)
 
 
 class SalesforcePermissionsError(Exception):
@@ -45,7 +111,7 @@ class SalesforceOAuth2Adapter(SalesforceOAuth2BaseAdapter):
         return base_url
 
     def complete_login(self, request, app, token, **kwargs):
-     
+
         token = fernet_decrypt(token.token)
         headers = {"Authorization": f"Bearer {token}"}
         verifier = request.session["socialaccount_state"][1]
@@ -53,7 +119,7 @@ class SalesforceOAuth2Adapter(SalesforceOAuth2BaseAdapter):
             "Calling back to Salesforce to complete login.",
             extra={"tag": "oauth", "context": {"verifier": verifier}},
         )
-        resp = requests.get(self.userinfo_url, headers=headers)
+        resp = _get(self.userinfo_url, headers=headers)
         resp.raise_for_status()
         user_data = resp.json()
         extra_data = {
@@ -90,9 +156,24 @@ class SalesforceOAuth2Adapter(SalesforceOAuth2BaseAdapter):
     def get_org_details(self, urls, org_id, token):
         headers = {"Authorization": f"Bearer {token}"}
 
+        # The org request doesn't depend on the permission check, so send it
+        # from another thread while checking, to wait for one round trip
+        # rather than two. If the check fails, its response is dropped.
+        org_future = None
+        if ORGID_RE.match(org_id):
+            org_url = (urls["sobjects"] + "Organization/{org_id}").format(
+                version="48.0", org_id=org_id
+            )
+            executor = ThreadPoolExecutor(max_workers=1)
+            org_future = executor.submit(
+                copy_log_context(_get), org_url, headers=headers
+            )
+            # The thread exits once the request is done; don't wait for it.
+            executor.shutdown(wait=False)
+
         # Confirm canModifyAllData:
         org_info_url = (urls["rest"] + "connect/organization").format(version="48.0")
-        resp = requests.get(org_info_url, headers=headers)
+        resp = _get(org_info_url, headers=headers)
         resp.raise_for_status()
 
         # Also contains resp.json()["name"], but not ["type"], so it's
@@ -104,10 +185,7 @@ class SalesforceOAuth2Adapter(SalesforceOAuth2BaseAdapter):
 
         # Get org name and type:
         self._validate_org_id(org_id)
-        org_url = (urls["sobjects"] + "Organization/{org_id}").format(
-            version="48.0", org_id=org_id
-        )
-        resp = requests.get(org_url, headers=headers)
+        resp = org_future.result()
         resp_json = resp.json()
         if (
             resp.status_code == 403
@@ -134,7 +212,5 @@ class SalesforceOAuth2Adapter(SalesforceOAuth2BaseAdapter):
         return super().parse_token(data)
 
 
-
-
 oauth2_login = OAuth2LoginView.adapter_view(SalesforceOAuth2Adapter)
 oauth2_callback = OAuth2CallbackView.adapter_view(SalesforceOAuth2Adapter)
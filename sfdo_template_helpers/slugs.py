@@ -1,11 +1,65 @@
 import itertools
+import re
+import threading
+from collections import namedtuple
 from contextlib import suppress
 
-from django.db import models
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, models, transaction
+from django.db.models.signals import class_prepared, post_delete, post_save
+from django.dispatch import receiver
 from django.utils.functional import cached_property
 from django.utils.text import slugify
 from django.utils.translation import gettext_lazy as _
 
+from .cache import LocalLRUCache
+
+SLUG_MAX_LENGTH = 50  # This from SlugField
+# Longest suffix (e.g. "-9999999") covered by the single query in _taken_slugs.
+SLUG_MAX_SUFFIX_LENGTH = 8
+# How many times ensure_slug retries after losing a race for the same slug.
+SLUG_CREATE_MAX_ATTEMPTS = 10
+
+
+class SlugCreationStats:
+    """
+    Process-wide counters for concurrent slug creation.
+
+    ``retries`` counts slug inserts that lost a race on the unique constraint
+    and were retried with the next free suffix; ``bulk_fallbacks`` counts
+    ``ensure_slugs`` batches that fell back to one ``ensure_slug`` per
+    instance for the same reason.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.retries = 0
+            self.bulk_fallbacks = 0
+
+    def increment(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def as_dict(self):
+        with self._lock:
+            return {"retries": self.retries, "bulk_fallbacks": self.bulk_fallbacks}
+
+
+slug_creation_stats = SlugCreationStats()
+
+ResolvedSlug = namedtuple("ResolvedSlug", ["parent_id", "slug", "is_canonical"])
+SlugRepairProgress = namedtuple(
+    "SlugRepairProgress", ["rows", "last_pk", "created", "deactivated"]
+)
+
+
+local_slug_cache = LocalLRUCache()
+
 
 class SlugMixin:
     """
@@ -32,20 +86,63 @@ class SlugMixin:
         self.slug_parent: the instance to assign as the slug parent.
         self.slug_field_name: the field on the main model to base the
             slug off of.
+        self.slug_prefetch_lookup: the prefetch_related lookup from this
+            model to its slugs, used by SlugQuerySet.with_slugs.
+
+    To read the slug without touching the slug table, add a nullable column
+    and name it in current_slug_field; it is kept in sync when slugs are
+    saved or deleted (only for slugs whose parent is this model)::
+
+        class Foo(SlugMixin, models.Model):
+            ...
+            current_slug = models.SlugField(null=True, editable=False)
+            current_slug_field = "current_slug"
     """
 
-    def _find_unique_slug(self, original):
-        max_length = 50  # This from SlugField
+    slug_prefetch_lookup = "slugs"
+    current_slug_field = None
 
-        candidate = original[:max_length]
+    def _slug_candidates(self, original):
+        candidate = original[:SLUG_MAX_LENGTH]
+        yield candidate
         # Ignore branches here because this loop should never end:
         # https://coverage.readthedocs.io/en/v4.5.x/branch.html#structurally-partial-branches
         for i in itertools.count(1):  # pragma: no branch
-            if not self.slug_class.objects.filter(slug=candidate).exists():
+            suffix = f"-{i}"
+            yield candidate[: SLUG_MAX_LENGTH - len(suffix)] + suffix
+
+    def _taken_slugs_queryset(self, original):
+        # Every candidate from _slug_candidates is the original, or the
+        # original cut to no shorter than this prefix plus a numeric suffix, so
+        # one query finds all the slugs that could collide, and only those;
+        # the startswith lets it use the slug index. n taken slugs can block
+        # at most n candidates, so this is exact up to ten million collisions.
+        candidate = original[:SLUG_MAX_LENGTH]
+        prefix = candidate[: SLUG_MAX_LENGTH - SLUG_MAX_SUFFIX_LENGTH]
+        suffixed = rf"^{re.escape(prefix)}.{{0,{len(candidate) - len(prefix)}}}-[0-9]+$"
+        return (
+            self.slug_class.objects.filter(
+                models.Q(slug=candidate)
+                | models.Q(slug__startswith=prefix, slug__regex=suffixed)
+            )
+            .order_by()
+            .values_list("slug", flat=True)
+        )
+
+    def _taken_slugs(self, original):
+        return set(self._taken_slugs_queryset(original))
+
+    def _find_unique_slug(self, original):
+        taken = self._taken_slugs(original)
+        for candidate in self._slug_candidates(original):  # pragma: no branch
+            if candidate not in taken:
                 return candidate
 
-            suffix = f"-{i}"
-            candidate = candidate[: max_length - len(suffix)] + suffix
+    async def _afind_unique_slug(self, original):
+        taken = {slug async for slug in self._taken_slugs_queryset(original)}
+        for candidate in self._slug_candidates(original):  # pragma: no branch
+            if candidate not in taken:
+                return candidate
 
     @cached_property
     def slug_cache(self):
@@ -58,6 +155,10 @@ class SlugMixin:
 
     @property
     def slug(self):
+        if self.current_slug_field:
+            current_slug = getattr(self, self.current_slug_field)
+            if current_slug:
+                return current_slug
         try:
             return self.slug_cache[0]
         except IndexError:
@@ -67,6 +168,29 @@ class SlugMixin:
     def old_slugs(self):
         return self.slug_cache[1:]
 
+    async def _aget_slug_cache(self):
+        # Fills the same cache as slug_cache, so sync and async reads agree.
+        if "slug_cache" not in self.__dict__:
+            self.__dict__["slug_cache"] = [
+                slug.slug async for slug in self.slug_queryset.all() if slug.is_active
+            ]
+        return self.__dict__["slug_cache"]
+
+    async def aget_slug(self):
+        if self.current_slug_field:
+            current_slug = getattr(self, self.current_slug_field)
+            if current_slug:
+                return current_slug
+        slug_cache = await self._aget_slug_cache()
+        try:
+            return slug_cache[0]
+        except IndexError:
+            return None
+
+    async def aget_old_slugs(self):
+        slug_cache = await self._aget_slug_cache()
+        return slug_cache[1:]
+
     @property
     def slug_parent(self):
         return self
@@ -75,16 +199,264 @@ class SlugMixin:
     def slug_queryset(self):
         return self.slugs
 
-    def ensure_slug(self):
-        if not self.slug_queryset.filter(is_active=True).exists():
-            sluggable_name = getattr(self, getattr(self, "slug_field_name", "name"))
-            slug = slugify(sluggable_name)
-            slug = self._find_unique_slug(slug)
+    def _get_base_slug(self):
+        sluggable_name = getattr(self, getattr(self, "slug_field_name", "name"))
+        return slugify(sluggable_name)
+
+    def _create_slug(self, slug):
+        # Use a savepoint so losing a race doesn't break any surrounding
+        # transaction.
+        with transaction.atomic():
             self.slug_class.objects.create(
                 parent=self.slug_parent, slug=slug, is_active=True
             )
+        if self.current_slug_field:
+            setattr(self, self.current_slug_field, slug)
+
+    def ensure_slug(self):
+        """
+        Give this instance an active slug if it doesn't have one.
+
+        Safe to call concurrently: if another process claims the same slug
+        first, we retry with the next free one. Returns whether a slug was
+        created.
+        """
+        base = self._get_base_slug()
+        created = False
+        for attempt in range(1, SLUG_CREATE_MAX_ATTEMPTS + 1):  # pragma: no branch
+            if self.slug_queryset.filter(is_active=True).exists():
+                break
+            slug = self._find_unique_slug(base)
+            try:
+                self._create_slug(slug)
+                created = True
+                break
+            except IntegrityError:
+                # Another process took this slug between our lookup and our
+                # insert; look again, which will now see their slug.
+                if attempt == SLUG_CREATE_MAX_ATTEMPTS:
+                    raise
+                slug_creation_stats.increment("retries")
         with suppress(AttributeError):
             del self.slug_cache  # Clear cached property
+        return created
+
+    async def aensure_slug(self):
+        """
+        Async version of ensure_slug, using Django's async ORM (Django 4.1+).
+
+        The insert runs in a savepoint, like ensure_slug, which the async ORM
+        can't open itself; so it goes through sync_to_async, just as
+        ``acreate`` would. ``slug_parent`` must not need a query to evaluate.
+        """
+        # Imported here, as Django 2.2 doesn't install asgiref.
+        from asgiref.sync import sync_to_async
+
+        base = self._get_base_slug()
+        created = False
+        for attempt in range(1, SLUG_CREATE_MAX_ATTEMPTS + 1):  # pragma: no branch
+            if await self.slug_queryset.filter(is_active=True).aexists():
+                break
+            slug = await self._afind_unique_slug(base)
+            try:
+                await sync_to_async(self._create_slug)(slug)
+                created = True
+                break
+            except IntegrityError:
+                if attempt == SLUG_CREATE_MAX_ATTEMPTS:
+                    raise
+                slug_creation_stats.increment("retries")
+        with suppress(AttributeError):
+            del self.slug_cache  # Clear cached property
+        return created
+
+    @classmethod
+    def ensure_slugs(cls, instances, batch_size=500):
+        """
+        Bulk version of ensure_slug, for backfilling slugs on many instances.
+
+        Takes a queryset or iterable of instances and works through it in
+        batches of ``batch_size``. Each batch costs one query to find the
+        instances that already have an active slug, one query to check the
+        candidate slugs, one query per distinct name that collides, and the
+        ``bulk_create``. Returns the number of slugs created.
+        """
+        if isinstance(instances, models.QuerySet):
+            instances = instances.iterator(chunk_size=batch_size)
+        instances = iter(instances)
+        claimed = set()
+        created = 0
+        for batch in iter(lambda: list(itertools.islice(instances, batch_size)), []):
+            slugs = cls._build_slugs(batch, claimed)
+            try:
+                with transaction.atomic():
+                    cls.slug_class.objects.bulk_create(slugs, batch_size=batch_size)
+                    if cls.current_slug_field:
+                        cls._set_current_slugs(slugs, batch_size)
+                created += len(slugs)
+                # bulk_create doesn't send post_save, so clear any cached misses:
+                cls.slug_class.invalidate_resolved_slugs(slug.slug for slug in slugs)
+            except IntegrityError:
+                # Another process created a clashing slug concurrently. Fall
+                # back to the one-at-a-time path, which retries on conflicts.
+                slug_creation_stats.increment("bulk_fallbacks")
+                created += sum(instance.ensure_slug() for instance in batch)
+            for instance in batch:
+                with suppress(AttributeError):
+                    del instance.slug_cache  # Clear cached property
+        return created
+
+    @classmethod
+    def _set_current_slugs(cls, slugs, batch_size):
+        # Every new slug is its parent's only active slug, so it's canonical.
+        for slug in slugs:
+            setattr(slug.parent, cls.current_slug_field, slug.slug)
+        cls._default_manager.bulk_update(
+            [slug.parent for slug in slugs],
+            [cls.current_slug_field],
+            batch_size=batch_size,
+        )
+
+    @classmethod
+    def repair_slugs(cls, batch_size=500, start_after=None, deactivate_old=False):
+        """
+        Give every row without an active slug a new one and, if
+        ``deactivate_old`` is set, deactivate all but the newest active slug
+        on rows that have several.
+
+        Rows are streamed in primary key order, starting after the
+        ``start_after`` pk, and each batch of ``batch_size`` rows is repaired
+        in its own transaction. Yields a ``SlugRepairProgress`` after each
+        batch, so an interrupted run can resume from its ``last_pk``.
+        """
+        queryset = cls._default_manager.order_by("pk")
+        if start_after is not None:
+            queryset = queryset.filter(pk__gt=start_after)
+        rows = queryset.iterator(chunk_size=batch_size)
+        for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+            with transaction.atomic():
+                created = cls.ensure_slugs(batch, batch_size=batch_size)
+                deactivated = 0
+                if deactivate_old:
+                    deactivated = cls._deactivate_old_slugs(batch)
+            yield SlugRepairProgress(len(batch), batch[-1].pk, created, deactivated)
+
+    @classmethod
+    def _deactivate_old_slugs(cls, batch):
+        parent_ids = {instance.slug_parent.pk for instance in batch}
+        canonical = cls.slug_class.canonical_slugs(parent_ids)
+        old = dict(
+            cls.slug_class.objects.filter(parent__in=parent_ids, is_active=True)
+            .exclude(slug__in=canonical.values())
+            .values_list("pk", "slug")
+        )
+        if old:
+            cls.slug_class.objects.filter(pk__in=old).update(is_active=False)
+            # update() doesn't send post_save:
+            cls.slug_class.invalidate_resolved_slugs(old.values())
+        for instance in batch:
+            with suppress(AttributeError):
+                del instance.slug_cache  # Clear cached property
+        return len(old)
+
+    @classmethod
+    def sync_current_slugs(cls, batch_size=500, fix=True):
+        """
+        Check ``current_slug_field`` against the slug table for every row,
+        walking the table in primary key order ``batch_size`` rows at a time.
+
+        Returns the number of rows that were out of sync, and updates them
+        unless ``fix`` is false.
+        """
+        field = cls.current_slug_field
+        queryset = cls._default_manager.order_by("pk").values_list("pk", field)
+        stale_count = 0
+        last_pk = None
+        while True:
+            page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            page = list(page[:batch_size])
+            if not page:
+                return stale_count
+            last_pk = page[-1][0]
+            canonical = cls.slug_class.canonical_slugs([pk for pk, _ in page])
+            stale = [
+                cls(pk=pk, **{field: canonical.get(pk)})
+                for pk, current in page
+                if current != canonical.get(pk)
+            ]
+            stale_count += len(stale)
+            if fix and stale:
+                cls._default_manager.bulk_update(stale, [field])
+
+    @classmethod
+    def _build_slugs(cls, batch, claimed):
+        parents = {}
+        for instance in batch:
+            parents.setdefault(instance.slug_parent.pk, instance)
+        has_active = set(
+            cls.slug_class.objects.filter(
+                parent__in=list(parents), is_active=True
+            ).values_list("parent", flat=True)
+        )
+        needs_slug = {
+            pk: instance for pk, instance in parents.items() if pk not in has_active
+        }
+        bases = {
+            pk: instance._get_base_slug()[:SLUG_MAX_LENGTH]
+            for pk, instance in needs_slug.items()
+        }
+        exact_taken = set(
+            cls.slug_class.objects.filter(slug__in=bases.values()).values_list(
+                "slug", flat=True
+            )
+        )
+
+        taken_by_prefix = {}
+        slugs = []
+        for pk, instance in needs_slug.items():
+            base = bases[pk]
+            if base in exact_taken or base in claimed:
+                if base not in taken_by_prefix:
+                    taken_by_prefix[base] = instance._taken_slugs(base)
+                taken = taken_by_prefix[base]
+                slug = next(
+                    candidate
+                    for candidate in instance._slug_candidates(base)
+                    if candidate not in taken and candidate not in claimed
+                )
+            else:
+                slug = base
+            claimed.add(slug)
+            slugs.append(
+                cls.slug_class(parent=instance.slug_parent, slug=slug, is_active=True)
+            )
+        return slugs
+
+
+class SlugQuerySet(models.QuerySet):
+    """
+    Use this as the manager for a SlugMixin model to fetch slugs efficiently::
+
+        class Foo(SlugMixin, models.Model):
+            ...
+            objects = SlugQuerySet.as_manager()
+
+        Foo.objects.with_slugs()
+    """
+
+    def with_slugs(self):
+        """
+        Prefetch only active slugs, most recent first, so ``slug`` and
+        ``old_slugs`` take no further queries on any row.
+        """
+        return self.prefetch_related(
+            models.Prefetch(
+                self.model.slug_prefetch_lookup,
+                queryset=self.model.slug_class.objects.filter(is_active=True).order_by(
+                    "-created_at"
+                ),
+            )
+        )
 
 
 class AbstractSlug(models.Model):
@@ -103,3 +475,106 @@ class AbstractSlug(models.Model):
 
     def __str__(self):
         return self.slug
+
+    @classmethod
+    def _resolver_key(cls, slug):
+        return f"sfdo-slug:{cls._meta.label_lower}:{slug}"
+
+    @classmethod
+    def resolve(cls, slug):
+        """
+        Look up an active slug, returning a ``ResolvedSlug`` or ``None``.
+
+        ``ResolvedSlug.slug`` is the parent's canonical (most recent active)
+        slug, so a view given an old slug can redirect without another query.
+        Results are cached in an in-process LRU in front of Django's cache,
+        and invalidated when any slug for the same parent is saved or deleted.
+        """
+        key = cls._resolver_key(slug)
+        cached = local_slug_cache.get(key)
+        if cached is None:
+            cache = caches[getattr(settings, "SLUG_RESOLVER_CACHE", "default")]
+            cached = cache.get(key)
+            if cached is None:
+                parents = cls.objects.filter(slug=slug, is_active=True).values("parent")
+                row = (
+                    cls.objects.filter(is_active=True, parent__in=parents)
+                    .order_by("-created_at")
+                    .values_list("parent", "slug")
+                    .first()
+                )
+                # Cache misses too, as an empty tuple:
+                cached = tuple(row or ())
+                cache.set(
+                    key, cached, getattr(settings, "SLUG_RESOLVER_CACHE_TIMEOUT", 300)
+                )
+            local_slug_cache.set(
+                key,
+                cached,
+                getattr(settings, "SLUG_RESOLVER_LOCAL_TIMEOUT", 5),
+                getattr(settings, "SLUG_RESOLVER_LOCAL_MAX_SIZE", 1024),
+            )
+        if not cached:
+            return None
+        parent_id, canonical = cached
+        return ResolvedSlug(parent_id, canonical, canonical == slug)
+
+    @classmethod
+    def canonical_slugs(cls, parent_ids):
+        """
+        Map each of the given parents that has an active slug to its
+        canonical (most recent active) slug, in one query.
+        """
+        canonical = {}
+        for parent_id, slug in (
+            cls.objects.filter(parent__in=parent_ids, is_active=True)
+            .order_by("-created_at")
+            .values_list("parent", "slug")
+        ):
+            canonical.setdefault(parent_id, slug)
+        return canonical
+
+    @classmethod
+    def invalidate_resolved_slugs(cls, slugs):
+        """
+        Clear cached resolve() results for the slugs. Django's cache is
+        cleared once the transaction commits: a resolve() elsewhere before then
+        reads the old rows, and would put them back.
+        """
+        keys = [cls._resolver_key(slug) for slug in slugs]
+        local_slug_cache.delete_many(keys)
+
+        def clear():
+            local_slug_cache.delete_many(keys)
+            cache = caches[getattr(settings, "SLUG_RESOLVER_CACHE", "default")]
+            cache.delete_many(keys)
+
+        transaction.on_commit(clear)
+
+
+def _invalidate_resolved_slugs(sender, instance, **kwargs):
+    # A change to any slug can change the canonical slug for all its siblings.
+    slugs = set(
+        sender.objects.filter(parent=instance.parent_id).values_list("slug", flat=True)
+    )
+    slugs.add(instance.slug)
+    sender.invalidate_resolved_slugs(slugs)
+
+
+def _sync_current_slug(sender, instance, **kwargs):
+    parent_model = sender._meta.get_field("parent").related_model
+    field = getattr(parent_model, "current_slug_field", None)
+    if field:
+        canonical = sender.canonical_slugs([instance.parent_id])
+        parent_model._default_manager.filter(pk=instance.parent_id).update(
+            **{field: canonical.get(instance.parent_id)}
+        )
+
+
+@receiver(class_prepared)
+def _connect_slug_signals(sender, **kwargs):
+    if issubclass(sender, AbstractSlug) and not sender._meta.abstract:
+        post_save.connect(_invalidate_resolved_slugs, sender=sender)
+        post_delete.connect(_invalidate_resolved_slugs, sender=sender)
+        post_save.connect(_sync_current_slug, sender=sender)
+        post_delete.connect(_sync_current_slug, sender=sender)
@@ -4,11 +4,12 @@ from sfdo_template_helpers.fields import (
     MarkdownField,
     StringField,
 )
-from sfdo_template_helpers.slugs import AbstractSlug, SlugMixin
+from sfdo_template_helpers.slugs import AbstractSlug, SlugMixin, SlugQuerySet
 
 
 class Markdowner(models.Model):
     description = MarkdownField(null=True)
+    stored_description = MarkdownField(null=True, store_html=True)
     unsafe_description = MarkdownField(
         null=True,
         is_safe=False,
@@ -27,3 +28,20 @@ class FooSlug(AbstractSlug):
 class Foo(SlugMixin, models.Model):
     name = models.CharField(max_length=50, unique=True)
     slug_class = FooSlug
+
+    objects = SlugQuerySet.as_manager()
+
+
+class BarSlug(AbstractSlug):
+    parent = models.ForeignKey(
+        "Bar", on_delete=models.PROTECT, related_name="slugs"
+    )
+
+
+class Bar(SlugMixin, models.Model):
+    name = models.CharField(max_length=50, unique=True)
+    current_slug = models.SlugField(null=True, editable=False)
+    slug_class = BarSlug
+    current_slug_field = "current_slug"
+
+    objects = SlugQuerySet.as_manager()
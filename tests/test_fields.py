@@ -1,7 +1,31 @@
+import copy
+import io
+import json
+import threading
+from types import SimpleNamespace
+
 import pytest
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, models
 from django.forms.fields import CharField as CharFormField
+from django.template import Context, Engine
+from django.utils.html import conditional_escape
+from django.utils.safestring import SafeString, mark_safe
+from markdown import Markdown
 
 from sfdo_template_helpers.fields import MarkdownField, StringField
+from rest_framework import serializers
+
+from sfdo_template_helpers.fields.markdown import (
+    StoredHTMLField,
+    _render_chunk,
+    markdown_digest,
+    markdown_render_cache,
+    render_markdown,
+)
+from sfdo_template_helpers.fields.serializers import MarkdownHTMLField
 from tests.models import Markdowner
 
 
@@ -53,6 +77,581 @@ def test_read_only():
         md.description_html = "Test"
 
 
+@pytest.fixture
+def render_spy(mocker):
+    return mocker.spy(Markdown, "convert")
+
+
+@pytest.fixture
+def render_cache(settings):
+    settings.MARKDOWN_RENDER_CACHE_SIZE = 2
+    markdown_render_cache.clear()
+    yield markdown_render_cache
+    markdown_render_cache.clear()
+
+
+class TestRenderMemoization:
+    def test_memoized_on_instance(self, render_spy):
+        md = Markdowner(description="Test")
+        assert md.description_html == md.description_html == "<p>Test</p>"
+        assert render_spy.call_count == 1
+        assert hasattr(md.description_html, "__html__")
+
+    def test_invalidated_by_change(self, render_spy):
+        md = Markdowner(description="Test")
+        assert md.description_html == "<p>Test</p>"
+        md.description = "Changed"
+        assert md.description_html == "<p>Changed</p>"
+        assert render_spy.call_count == 2
+
+    def test_not_shared_by_default(self, render_spy):
+        str(Markdowner(description="Test").description_html)
+        str(Markdowner(description="Test").description_html)
+        assert render_spy.call_count == 2
+
+    def test_shared_cache(self, render_spy, render_cache):
+        str(Markdowner(description="Test").description_html)
+        assert Markdowner(description="Test").description_html == "<p>Test</p>"
+        assert render_spy.call_count == 1
+
+    def test_shared_cache__keyed_by_allowlists(self, render_spy, render_cache):
+        md = Markdowner(description="<b>Test</b>", unsafe_description="<b>Test</b>")
+        assert md.description_html == "<p><b>Test</b></p>"
+        assert md.unsafe_description_html == "<p>&lt;b&gt;Test&lt;/b&gt;</p>"
+        assert render_spy.call_count == 2
+
+    def test_shared_cache__bounded(self, render_spy, render_cache):
+        for text in ("a", "b", "c", "a"):
+            str(Markdowner(description=text).description_html)
+        assert render_spy.call_count == 4
+
+    def test_allowlist_key(self):
+        assert MarkdownField(allowed_tags=["b", "a"]).allowlist_key == (
+            MarkdownField(allowed_tags=["a", "b"]).allowlist_key
+        )
+        assert MarkdownField(allowed_attrs=["title"]).allowlist_key != (
+            MarkdownField().allowlist_key
+        )
+
+
+class TestLazyHTML:
+    def test_not_rendered_until_used(self, render_spy):
+        md = Markdowner(description="*Test*", unsafe_description=" ")
+        assert md.description_html
+        assert not md.unsafe_description_html
+        assert not render_spy.called
+        assert str(md.description_html) == "<p><em>Test</em></p>"
+        assert render_spy.call_count == 1
+
+    def test_renders_value_when_accessed(self):
+        md = Markdowner(description="a")
+        html = md.description_html
+        md.description = "b"
+        assert html == "<p>a</p>"
+        assert md.description_html == "<p>b</p>"
+
+    def test_safe(self):
+        md = Markdowner(description="*Test*")
+        assert isinstance(str(md.description_html), SafeString)
+        assert md.description_html.__html__() == "<p><em>Test</em></p>"
+        assert mark_safe(md.description_html).__html__() == "<p><em>Test</em></p>"
+        assert conditional_escape(md.description_html) == "<p><em>Test</em></p>"
+
+    def test_unsafe(self):
+        md = Markdowner(unsafe_description="a")
+        assert not isinstance(str(md.unsafe_description_html), SafeString)
+        assert mark_safe(md.unsafe_description_html) == "<p>a</p>"
+        assert conditional_escape(md.unsafe_description_html) == "&lt;p&gt;a&lt;/p&gt;"
+
+    def test_templates(self, render_spy):
+        template = Engine().from_string(
+            "{% if md.description_html %}{{ md.description_html }}{% endif %}"
+            "{% if md.name %}{{ md.unsafe_description_html }}{% endif %}"
+            "|{{ md.unsafe_description_html }}"
+            "|{{ md.description_html|truncatewords_html:1 }}"
+        )
+        md = Markdowner(description="*a* b", unsafe_description="c")
+
+        result = template.render(Context({"md": md}))
+
+        assert result == (
+            "<p><em>a</em> b</p>|&lt;p&gt;c&lt;/p&gt;|<p><em>a</em> …</p>"
+        )
+
+    def test_str_like(self):
+        html = Markdowner(description="a").description_html
+        other = Markdowner(description="b").description_html
+        assert repr(html) == "LazySafeHTML('<p>a</p>')"
+        assert html == Markdowner(description="a").description_html
+        assert html < other
+        assert html < "<p>b</p>"
+        assert html <= "<p>a</p>"
+        assert other > html
+        assert other >= "<p>b</p>"
+        assert "<p>b</p>" > html
+        assert "<p>0</p>" < html
+        assert "{:>9}".format(html) == " <p>a</p>"
+        assert f"{html}" == "<p>a</p>"
+        assert html * 2 == "<p>a</p><p>a</p>"
+        assert 2 * html == "<p>a</p><p>a</p>"
+        assert {html: 1}["<p>a</p>"] == 1
+        assert len(html) == 8
+        assert "a" in html
+        assert list(html)[:3] == ["<", "p", ">"]
+        assert html[3] == "a"
+        assert html + "!" == "<p>a</p>!"
+        assert "!" + html == "!<p>a</p>"
+        assert html.startswith("<p>")
+        assert "%s" % html == "<p>a</p>"
+        assert Markdowner(description="%s").description_html % "x" == "<p>x</p>"
+        assert json.dumps(html, cls=DjangoJSONEncoder) == '"<p>a</p>"'
+        assert copy.copy(html) == html
+        with pytest.raises(AttributeError):
+            html._missing
+
+
+class TestExcerpt:
+    @pytest.mark.parametrize(
+        "kwargs, raw_md, expected",
+        [
+            ({}, "\n\nOne\ntwo\n \nThree", "One\ntwo"),
+            ({"excerpt_blocks": 2}, "One\r\n\r\nTwo\n\nThree", "One\r\n\r\nTwo"),
+            ({"excerpt_blocks": 2}, "One\n\nTwo", "One\n\nTwo"),
+            ({"excerpt_length": 8}, "Some long words", "Some…"),
+            ({"excerpt_length": 9}, "Some long words", "Some long…"),
+            ({"excerpt_length": 4}, "Something", "Some…"),
+            ({"excerpt_length": 4, "excerpt_blocks": None}, "A\n\nB\n\nC", "A\n\nB…"),
+        ],
+    )
+    def test_excerpt(self, kwargs, raw_md, expected):
+        assert MarkdownField(**kwargs).excerpt(raw_md) == expected
+
+    def test_property(self, render_spy):
+        md = Markdowner(description="*One*\n\n" + "Two " * 100000)
+        assert md.description_excerpt_html
+        assert not render_spy.called
+        assert md.description_excerpt_html == "<p><em>One</em></p>"
+        assert md.description_excerpt_html == "<p><em>One</em></p>"
+        assert hasattr(md.description_excerpt_html, "__html__")
+        assert render_spy.call_count == 1
+        assert render_spy.call_args.args[1] == "*One*"
+
+    def test_separate_from_full_html(self):
+        md = Markdowner(description="One\n\nTwo")
+        assert md.description_excerpt_html == "<p>One</p>"
+        assert md.description_html == "<p>One</p>\n<p>Two</p>"
+        md.description = "Three"
+        assert md.description_excerpt_html == "<p>Three</p>"
+
+    def test_shared_cache(self, render_spy, render_cache):
+        str(Markdowner(description="One\n\nTwo").description_excerpt_html)
+        str(Markdowner(description="One\n\nThree").description_excerpt_html)
+        assert render_spy.call_count == 1
+
+    def test_deconstruct(self):
+        field = MarkdownField(excerpt_blocks=2, excerpt_length=100)
+        assert field.deconstruct()[3] == {"excerpt_blocks": 2, "excerpt_length": 100}
+
+
+class TestMaxRenderLength:
+    def test_render(self, render_spy, caplog):
+        field = MarkdownField(max_render_length=3)
+        assert field.render("abc") == "<p>abc</p>"
+        assert field.render("abcd") == ""
+        assert render_spy.call_count == 1
+        assert "over the limit of 3" in caplog.text
+
+    def test_setting(self, settings):
+        settings.MARKDOWN_MAX_RENDER_LENGTH = 3
+        md = Markdowner(description="abcd", unsafe_description="abc")
+        assert md.description_html == ""
+        assert md.unsafe_description_html == "<p>abc</p>"
+
+    def test_falsy_without_rendering(self, settings, render_spy):
+        settings.MARKDOWN_MAX_RENDER_LENGTH = 3
+        md = Markdowner(description="abcd", unsafe_description="abc")
+        assert not md.description_html
+        assert md.unsafe_description_html
+        assert not render_spy.called
+
+    def test_excerpt_of_long_document(self):
+        md = Markdowner(description="One\n\n" + "Two " * 1000)
+        md._meta.get_field("description").max_render_length = 100
+        try:
+            assert md.description_html == ""
+            assert not md.description_html
+            assert md.description_excerpt_html == "<p>One</p>"
+            assert md.description_excerpt_html
+        finally:
+            md._meta.get_field("description").max_render_length = None
+
+    def test_render_many(self, settings):
+        settings.MARKDOWN_BULK_PROCESS_THRESHOLD = 1
+        settings.MARKDOWN_BULK_WORKERS = 1
+        field = MarkdownField(max_render_length=3)
+        assert field.render_many(["abc", "abcd"]) == {"abc": "<p>abc</p>", "abcd": ""}
+
+    def test_validation(self):
+        field = MarkdownField(max_render_length=3)
+        field.clean("abc", None)
+        with pytest.raises(ValidationError):
+            field.clean("abcd", None)
+        assert MarkdownField().validators == []
+
+    def test_deconstruct(self):
+        field = MarkdownField(max_render_length=3)
+        assert field.deconstruct()[3] == {"max_render_length": 3}
+
+
+class TestRenderers:
+    def test_reused(self, render_spy):
+        field = Markdowner._meta.get_field("description")
+        field.render("a")
+        field.render("b")
+        assert render_spy.call_args_list[0].args[0] is (
+            render_spy.call_args_list[1].args[0]
+        )
+
+    def test_reset_between_documents(self):
+        field = Markdowner._meta.get_field("description")
+        assert "href" in field.render("[a][x]\n\n[x]: http://example.com")
+        assert field.render("[a][x]") == "<p>[a][x]</p>"
+
+    def test_reset_after_error(self, mocker):
+        field = MarkdownField()
+        field.render("Test")
+        converter = field._renderers.converter
+        mocker.patch.object(converter.parser, "parseDocument", side_effect=ValueError)
+        reset = mocker.spy(converter, "reset")
+        with pytest.raises(ValueError):
+            field.render("Test")
+        assert reset.called
+
+    def test_per_thread(self):
+        field = MarkdownField()
+        field.render("Test")
+        converters = [field._renderers.converter]
+
+        def render():
+            assert field.render("Test") == "<p>Test</p>"
+            converters.append(field._renderers.converter)
+
+        thread = threading.Thread(target=render)
+        thread.start()
+        thread.join()
+        assert converters[0] is not converters[1]
+
+
+@pytest.mark.django_db
+class TestStoredHTML:
+    def test_saved(self):
+        md = Markdowner.objects.create(stored_description="*Test*")
+        assert md.stored_description_html_stored == "<p><em>Test</em></p>"
+        md.stored_description = None
+        md.save()
+        md.refresh_from_db()
+        assert md.stored_description_html_stored is None
+        assert md.stored_description_html == ""
+
+    def test_read_without_rendering(self, render_spy):
+        Markdowner.objects.create(stored_description="*Test*")
+        render_spy.reset_mock()
+
+        md = Markdowner.objects.get()
+
+        assert md.stored_description_html == "<p><em>Test</em></p>"
+        assert hasattr(md.stored_description_html, "__html__")
+        assert not render_spy.called
+
+    def test_markdown_updated_without_save(self, render_spy):
+        md = Markdowner.objects.create(stored_description="*old*")
+        Markdowner.objects.filter(pk=md.pk).update(stored_description="*new*")
+        render_spy.reset_mock()
+
+        md = Markdowner.objects.get()
+
+        assert md.stored_description_html == "<p><em>new</em></p>"
+        assert render_spy.call_count == 1
+
+    def test_html_without_digest_not_trusted(self):
+        md = Markdowner.objects.create(stored_description="hi")
+        Markdowner.objects.update(stored_description_html_stored="<p>stale</p>")
+        md = Markdowner.objects.get()
+        assert md.stored_description_html_stored == "<p>stale</p>"
+        assert md.stored_description_html == "<p>hi</p>"
+
+    def test_rerender__adds_digest(self):
+        Markdowner.objects.create(stored_description="hi")
+        Markdowner.objects.update(stored_description_html_stored="<p>hi</p>")
+        field = Markdowner._meta.get_field("stored_description")
+        [progress] = field.rerender()
+        assert progress.updated == 1
+        assert Markdowner.objects.get().stored_description_html_stored.digest
+
+    def test_digest_stored_as_comment(self):
+        Markdowner.objects.create(stored_description="hi")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT stored_description_html_stored FROM tests_markdowner"
+            )
+            [(value,)] = cursor.fetchall()
+        assert value == f"<!--md:{markdown_digest('hi')}--><p>hi</p>"
+
+    def test_changed_before_save(self):
+        md = Markdowner.objects.create(stored_description="*Test*")
+        md = Markdowner.objects.get()
+        md.stored_description = "Changed"
+        assert md.stored_description_html == "<p>Changed</p>"
+
+    def test_assigned_html_not_trusted(self):
+        md = Markdowner(
+            stored_description="hi",
+            stored_description_html_stored="<script>x</script>",
+        )
+        assert md.stored_description_html == "<p>hi</p>"
+        md.save()
+        assert md.stored_description_html_stored == "<p>hi</p>"
+        md = Markdowner.objects.get()
+        md.stored_description_html_stored = "<script>x</script>"
+        md.save()
+        md.refresh_from_db()
+        assert md.stored_description_html_stored == "<p>hi</p>"
+
+    def test_rendered_on_save(self, render_spy):
+        md = Markdowner.objects.create(stored_description="*Test*")
+        render_spy.reset_mock()
+        md.save()
+        assert render_spy.call_count == 1
+        assert md.stored_description_html == "<p><em>Test</em></p>"
+        assert render_spy.call_count == 1
+
+    def test_deferred(self):
+        Markdowner.objects.create(stored_description="*Test*")
+        md = Markdowner.objects.defer("stored_description").get()
+        md.name = "Name"
+        md.save()
+        md = Markdowner.objects.get()
+        assert md.stored_description_html_stored == "<p><em>Test</em></p>"
+
+    def test_deconstruct(self):
+        name, path, args, kwargs = MarkdownField(store_html=True).deconstruct()
+        assert kwargs == {"store_html": True}
+        field = Markdowner._meta.get_field("stored_description_html_stored")
+        name, path, args, kwargs = field.deconstruct()
+        assert kwargs == {
+            "source": "stored_description",
+            "null": True,
+            "editable": False,
+        }
+
+    def test_added_once(self):
+        count = len(Markdowner._meta.local_fields)
+        StoredHTMLField(source="stored_description").contribute_to_class(
+            Markdowner, "stored_description_html_stored"
+        )
+        assert len(Markdowner._meta.local_fields) == count
+
+    def test_not_added_to_abstract_models(self):
+        class Meta:
+            abstract = True
+
+        model = type(
+            "AbstractMarkdowner",
+            (models.Model,),
+            {
+                "__module__": __name__,
+                "Meta": Meta,
+                "body": MarkdownField(store_html=True),
+            },
+        )
+        assert [field.name for field in model._meta.local_fields] == ["body"]
+
+    def test_rerender(self):
+        for text in ("a", "b", "c"):
+            Markdowner.objects.create(stored_description=text)
+        Markdowner.objects.create()
+        stale = Markdowner.objects.exclude(stored_description="a")
+        stale.update(stored_description_html_stored="stale")
+        out = io.StringIO()
+
+        call_command(
+            "rerender_markdown", "tests.Markdowner", "--batch-size=2", stdout=out
+        )
+
+        assert sorted(
+            Markdowner.objects.values_list("stored_description_html_stored", flat=True)
+        ) == ["<p>a</p>", "<p>b</p>", "<p>c</p>", "stale"]
+        assert "Updated 2 of 3 tests.Markdowner rows" in out.getvalue()
+
+    def test_rerender__start_after(self):
+        first, second = [
+            Markdowner.objects.create(stored_description=text) for text in "ab"
+        ]
+        Markdowner.objects.update(stored_description_html_stored="stale")
+        out = io.StringIO()
+
+        call_command(
+            "rerender_markdown",
+            "tests.Markdowner",
+            "--field=stored_description",
+            f"--start-after={first.pk}",
+            stdout=out,
+        )
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        assert first.stored_description_html_stored == "stale"
+        assert second.stored_description_html_stored == "<p>b</p>"
+
+    @pytest.mark.parametrize(
+        "args",
+        [
+            ["tests.Nope"],
+            ["tests.Foo"],
+            ["tests.Markdowner", "--field=description"],
+        ],
+    )
+    def test_rerender__errors(self, args):
+        with pytest.raises(CommandError):
+            call_command("rerender_markdown", *args)
+
+
+class TestRenderMany:
+    @pytest.fixture
+    def pool(self, settings):
+        settings.MARKDOWN_BULK_PROCESS_THRESHOLD = 1
+        settings.MARKDOWN_BULK_WORKERS = 2
+
+    def test_renders_each_document_once(self, render_spy):
+        field = MarkdownField()
+        result = field.render_many(["a", "b", "a", None])
+        assert result == {"a": "<p>a</p>", "b": "<p>b</p>"}
+        assert render_spy.call_count == 2
+
+    def test_pool(self, pool):
+        field = MarkdownField(allowed_tags=["em"])
+        documents = [f"*{i}*" for i in range(10)]
+        expected = {
+            document: f"&lt;p&gt;<em>{document[1]}</em>&lt;/p&gt;"
+            for document in documents
+        }
+        assert field.render_many(documents + [None]) == expected
+        # Reusing the pool.
+        assert field.render_many(documents) == expected
+
+    def test_pool__cpu_count(self, settings, mocker):
+        settings.MARKDOWN_BULK_PROCESS_THRESHOLD = 1
+        settings.MARKDOWN_BULK_WORKERS = None
+        mocker.patch("os.cpu_count", return_value=1)
+        assert MarkdownField().render_many(["a"]) == {"a": "<p>a</p>"}
+
+    def test_pool__off_by_default(self, settings, render_spy):
+        settings.MARKDOWN_BULK_PROCESS_THRESHOLD = 1
+        assert MarkdownField().render_many(["a"]) == {"a": "<p>a</p>"}
+        assert render_spy.call_count == 1
+
+    def test_pool__shared_cache(self, pool, render_cache):
+        field = MarkdownField()
+        assert field.render("a") == "<p>a</p>"
+        assert field.render_many(["a", "b"]) == {"a": "<p>a</p>", "b": "<p>b</p>"}
+        assert markdown_render_cache.get(field._cache_key("b")) == "<p>b</p>"
+
+    def test_render_chunk(self):
+        assert _render_chunk(["p"], {}, ["*a*", "b"]) == [
+            "<p>&lt;em&gt;a&lt;/em&gt;</p>",
+            "<p>b</p>",
+        ]
+        assert _render_chunk(["p"], {}, ["c"]) == ["<p>c</p>"]
+
+    def test_get_html_many(self, render_spy):
+        memoized = Markdowner(description="a")
+        str(memoized.description_html)
+        render_spy.reset_mock()
+        instances = [memoized, Markdowner(description="a"), Markdowner()]
+
+        result = render_markdown(instances, "description")
+
+        assert result == ["<p>a</p>", "<p>a</p>", ""]
+        assert all(hasattr(html, "__html__") for html in result)
+        assert render_spy.call_count == 1
+        assert instances[1].description_html == "<p>a</p>"
+        assert render_spy.call_count == 1
+
+    def test_get_html_many__unsafe(self):
+        result = render_markdown(
+            [Markdowner(unsafe_description="a")], "unsafe_description"
+        )
+        assert result == ["<p>a</p>"]
+        assert not hasattr(result[0], "__html__")
+
+    @pytest.mark.django_db
+    def test_render_markdown__queryset(self):
+        Markdowner.objects.create(description="a")
+        assert render_markdown(Markdowner.objects.all(), "description") == ["<p>a</p>"]
+        assert render_markdown(Markdowner.objects.none(), "description") == []
+
+
+class MarkdownerSerializer(serializers.Serializer):
+    description_html = MarkdownHTMLField(source="description")
+
+
+class ParentSerializer(serializers.Serializer):
+    markdowner_html = MarkdownHTMLField(source="markdowner.description")
+
+
+class NestedSerializer(serializers.Serializer):
+    items = MarkdownerSerializer(many=True)
+
+
+class TestMarkdownHTMLField:
+    def test_single(self):
+        data = MarkdownerSerializer(Markdowner(description="a")).data
+        assert data == {"description_html": "<p>a</p>"}
+
+    def test_list(self, render_spy, mocker):
+        render_many = mocker.spy(MarkdownField, "render_many")
+        instances = [Markdowner(description=text) for text in "aba"]
+        instances.append(Markdowner())
+
+        data = MarkdownerSerializer(instances, many=True).data
+
+        assert [row["description_html"] for row in data] == [
+            "<p>a</p>",
+            "<p>b</p>",
+            "<p>a</p>",
+            "",
+        ]
+        assert render_many.call_count == 1
+        assert render_spy.call_count == 2
+
+    def test_list__nested_source(self):
+        rows = [
+            SimpleNamespace(markdowner=Markdowner(description="a")),
+            SimpleNamespace(markdowner=None),
+        ]
+        data = ParentSerializer(rows, many=True).data
+        assert [row["markdowner_html"] for row in data] == ["<p>a</p>", None]
+
+    def test_list__nested_serializer(self):
+        rows = [
+            SimpleNamespace(items=[Markdowner(description=text) for text in "ab"]),
+            SimpleNamespace(items=[Markdowner(description="c")]),
+        ]
+        data = NestedSerializer(rows, many=True).data
+        assert [
+            [item["description_html"] for item in row["items"]] for row in data
+        ] == [
+            ["<p>a</p>", "<p>b</p>"],
+            ["<p>c</p>"],
+        ]
+
+    @pytest.mark.django_db
+    def test_list__manager(self, render_spy):
+        Markdowner.objects.create(description="a")
+        data = MarkdownerSerializer(Markdowner.objects, many=True).data
+        assert data == [{"description_html": "<p>a</p>"}]
+
+
 def test_deconstruct__default_suffix():
     field = MarkdownField()
     assert field.deconstruct() == (None, qual_name(MarkdownField), [], {})
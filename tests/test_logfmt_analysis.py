@@ -0,0 +1,158 @@
+import io
+import json
+import logging
+from types import SimpleNamespace
+
+import pytest
+from django.core.management import call_command
+
+from sfdo_template_helpers.logfmt_analysis import (
+    Histogram,
+    LogStats,
+    analyze_file,
+    analyze_stream,
+    parse_line,
+)
+from sfdo_template_helpers.logfmt_utils import LogfmtFormatter
+
+
+def make_line(level=logging.INFO, msg="Request finished", **attrs):
+    record = logging.LogRecord("name", level, "views", 1, msg, (), None)
+    record.__dict__.update(attrs)
+    return LogfmtFormatter().format(record)
+
+
+def make_log(count=100):
+    lines = [
+        make_line(
+            request_id=f"req-{i}",
+            tag="canonical",
+            context={
+                "duration_ms": i,
+                "db_queries": i % 5,
+                "path": "/a b",
+                "cached": i % 2 == 0,
+            },
+        )
+        for i in range(1, count + 1)
+    ]
+    lines.append(make_line(tag="canonical", context={"duration_ms": 0.5}))
+    lines.append(make_line(logging.ERROR, 'Bad "thing"', tag="oauth"))
+    lines.append(make_line(logging.ERROR, "Worse", tag="oauth"))
+    lines.append(make_line(logging.CRITICAL, "Worst"))
+    return "\n".join(lines) + "\n"
+
+
+@pytest.fixture
+def log_file(tmp_path):
+    path = tmp_path / "app.log"
+    path.write_text(make_log())
+    return str(path)
+
+
+def check_report(report):
+    assert report["lines"] == 104
+    assert report["errors_by_tag"] == {"oauth": 2, "external": 1}
+    assert report["errors_by_module"] == {"views": 3}
+    assert [item["id"] for item in report["slowest"]] == ["req-100", "req-99", "req-98"]
+    duration = report["fields"]["duration_ms"]
+    assert duration["count"] == 101
+    assert duration["p50"] == pytest.approx(50, rel=0.02)
+    assert duration["p95"] == pytest.approx(95, rel=0.02)
+    assert duration["p99"] == pytest.approx(99, rel=0.02)
+    assert duration["max"] == 100
+    assert report["fields"]["db_queries"]["p50"] == pytest.approx(2, rel=0.02)
+    assert "path" not in report["fields"]
+    assert "cached" not in report["fields"]
+
+
+def test_parse_line():
+    line = make_line(msg='Say "hi" now', tag="a b", context={"n": 1, "ok": True})
+    fields = parse_line(line)
+    assert fields["msg"] == 'Say "hi" now'
+    assert fields["tag"] == "a b"
+    assert fields["n"] == "1"
+    assert fields["ok"] == "true"
+    assert parse_line(line.encode("utf-8")) == fields
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_analyze_file(log_file, workers):
+    stats = analyze_file(log_file, workers=workers, chunk_size=1000, top=3)
+    check_report(stats.report())
+
+
+def test_analyze_file__empty(tmp_path):
+    path = tmp_path / "empty.log"
+    path.write_bytes(b"")
+    assert analyze_file(str(path), workers=1).report()["lines"] == 0
+
+
+def test_analyze_file__no_trailing_newline(tmp_path):
+    path = tmp_path / "app.log"
+    path.write_text(make_log().rstrip("\n") + "\n\n" + make_line(logging.ERROR, "x"))
+    assert analyze_file(str(path), workers=1).report()["lines"] == 105
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_analyze_stream(workers):
+    stream = io.BytesIO(make_log().encode("utf-8"))
+    stats = analyze_stream(stream, workers=workers, batch_lines=10, top=3)
+    check_report(stats.report())
+
+
+class TestHistogram:
+    def test_percentiles(self):
+        histogram = Histogram()
+        for value in [0, 0, -5, 1000, 2.5]:
+            histogram.add(value)
+
+        assert histogram.percentile(1) == -5
+        assert histogram.percentile(40) == 0
+        assert histogram.percentile(80) == pytest.approx(2.5, rel=0.02)
+        assert histogram.percentile(100) == 1000
+
+    def test_empty(self):
+        assert Histogram().percentile(50) is None
+
+    def test_merge(self):
+        first, second = Histogram(), Histogram()
+        first.add(1)
+        second.add(3)
+        first.merge(second)
+        assert (first.count, first.min, first.max) == (2, 1, 3)
+
+
+def test_log_stats__merge_new_field():
+    first, second = LogStats(), LogStats()
+    second.add_line(make_line(context={"rows": 3}).encode("utf-8"))
+    first.merge(second)
+    assert first.report()["fields"]["rows"]["count"] == 1
+
+
+def test_log_stats__non_finite_values():
+    stats = LogStats()
+    stats.add_line(b"id=a x=nan y=inf z=-inf duration_ms=NaN w=1")
+    report = stats.report()
+    assert list(report["fields"]) == ["w"]
+    assert report["lines"] == 1
+    assert report["slowest"] == []
+
+
+def test_command(log_file):
+    out = io.StringIO()
+    call_command("analyze_logfmt", log_file, "--workers=1", "--top=2", stdout=out)
+    output = out.getvalue()
+
+    assert output.startswith("Lines: 104\n")
+    assert "         2  oauth\n" in output
+    assert "           100  req-100\n" in output
+    assert "  duration_ms" in output
+
+
+def test_command__json_stdin(mocker):
+    stdin = SimpleNamespace(buffer=io.BytesIO(make_log().encode("utf-8")))
+    mocker.patch("sys.stdin", stdin)
+    out = io.StringIO()
+    call_command("analyze_logfmt", "--workers=1", "--top=3", "--json", stdout=out)
+    check_report(json.loads(out.getvalue()))
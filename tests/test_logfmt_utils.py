@@ -1,9 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
+import asyncio
 import datetime
+import decimal
+import io
+import json
 import logging
+import threading
+from collections import OrderedDict
+from contextlib import suppress
 from types import SimpleNamespace
 
-from sfdo_template_helpers.logfmt_utils import JobIDFilter, LogfmtFormatter
+import pytest
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+
+from sfdo_template_helpers.logfmt_utils import (
+    CanonicalLogFilter,
+    CanonicalLogMiddleware,
+    JobIDFilter,
+    JSONLinesFormatter,
+    LogfmtFormatter,
+    QueuedLogfmtHandler,
+    RequestIDMiddleware,
+    RequestLoggingMiddleware,
+    SamplingFilter,
+    _record_query,
+    add_log_context,
+    canonical_log_line,
+    copy_log_context,
+    job_id_var,
+    request_id_var,
+    with_canonical_log,
+    with_job_id,
+)
+from tests.models import Foo
 
 
 def test_job_id_filter():
@@ -24,6 +56,359 @@ def test_job_id_filter__no_job():
         assert record.job_id == "no-job-id"
 
 
+def test_job_id_filter__context():
+    with patch("sfdo_template_helpers.logfmt_utils.get_current_job") as get_id:
+        get_id.return_value.id = 123
+        log_filter = JobIDFilter()
+        record = SimpleNamespace()
+
+        @with_job_id
+        def job():
+            log_filter.filter(record)
+            log_filter.filter(record)
+
+        job()
+        assert record.job_id == 123
+        assert get_id.call_count == 1
+        assert job_id_var.get() is None
+
+
+def test_with_job_id__no_job():
+    with patch("sfdo_template_helpers.logfmt_utils.get_current_job") as get_id:
+        get_id.return_value = None
+        assert with_job_id(job_id_var.get)() == "no-job-id"
+
+
+def test_job_id_filter__request_id():
+    token = request_id_var.set("abc")
+    try:
+        record = SimpleNamespace()
+        JobIDFilter().filter(record)
+    finally:
+        request_id_var.reset(token)
+    assert record.request_id == "abc"
+
+
+def make_tagged_record(tag=None, level=logging.INFO):
+    record = logging.LogRecord("name", level, "module", 1, "Some message", (), None)
+    if tag:
+        record.tag = tag
+    return record
+
+
+class TestSamplingFilter:
+    def test_no_rules(self, settings):
+        settings.LOG_SAMPLING_RULES = {}
+        log_filter = SamplingFilter()
+        assert all(log_filter.filter(make_tagged_record("any")) for _ in range(100))
+
+    def test_rules_from_settings(self, settings):
+        settings.LOG_SAMPLING_RULES = {"tags": {"noisy": {"sample_rate": 0}}}
+        log_filter = SamplingFilter()
+        assert not log_filter.filter(make_tagged_record("noisy"))
+        assert log_filter.filter(make_tagged_record("quiet"))
+
+    def test_rate_limit(self):
+        log_filter = SamplingFilter(
+            {"tags": {"noisy": {"rate": 0.001, "burst": 3}}}, summary_interval=3600
+        )
+        results = [log_filter.filter(make_tagged_record("noisy")) for _ in range(5)]
+        assert results == [True, True, True, False, False]
+
+    def test_rate_limit__refills(self, mocker):
+        monotonic = mocker.patch(
+            "sfdo_template_helpers.logfmt_utils.time.monotonic", return_value=100
+        )
+        log_filter = SamplingFilter({"tags": {"noisy": {"rate": 2}}})
+        assert log_filter.filter(make_tagged_record("noisy"))
+        assert log_filter.filter(make_tagged_record("noisy"))
+        assert not log_filter.filter(make_tagged_record("noisy"))
+
+        monotonic.return_value = 100.5
+        assert log_filter.filter(make_tagged_record("noisy"))
+        assert not log_filter.filter(make_tagged_record("noisy"))
+
+    def test_rate_limit__default_burst(self, mocker):
+        monotonic = mocker.patch(
+            "sfdo_template_helpers.logfmt_utils.time.monotonic", return_value=100
+        )
+        log_filter = SamplingFilter({"tags": {"noisy": {"rate": 0.5}}})
+        assert log_filter.filter(make_tagged_record("noisy"))
+        assert not log_filter.filter(make_tagged_record("noisy"))
+
+        monotonic.return_value = 102
+        assert log_filter.filter(make_tagged_record("noisy"))
+
+    def test_sample_rate(self, mocker):
+        mocker.patch(
+            "sfdo_template_helpers.logfmt_utils.random.random",
+            side_effect=[0.05, 0.5, 0.09, 0.1],
+        )
+        log_filter = SamplingFilter({"levels": {"DEBUG": {"sample_rate": 0.1}}})
+        results = [
+            log_filter.filter(make_tagged_record(level=logging.DEBUG)) for _ in range(4)
+        ]
+        assert results == [True, False, True, False]
+        assert log_filter.filter(make_tagged_record())
+
+    def test_tag_and_level(self):
+        log_filter = SamplingFilter(
+            {
+                "tags": {"noisy": {"sample_rate": 1}},
+                "levels": {"DEBUG": {"sample_rate": 0}},
+            }
+        )
+        assert log_filter.filter(make_tagged_record("noisy"))
+        assert not log_filter.filter(make_tagged_record("noisy", logging.DEBUG))
+
+    def test_summary(self, caplog, mocker):
+        caplog.set_level(logging.WARNING)
+        monotonic = mocker.patch(
+            "sfdo_template_helpers.logfmt_utils.time.monotonic", return_value=100
+        )
+        log_filter = SamplingFilter(
+            {
+                "tags": {"noisy tag": {"sample_rate": 0}, "other": {"sample_rate": 1}},
+                "levels": {"DEBUG": {"sample_rate": 0}},
+            }
+        )
+        for _ in range(3):
+            log_filter.filter(make_tagged_record("noisy tag"))
+        log_filter.filter(make_tagged_record(level=logging.DEBUG))
+        assert not caplog.records
+
+        monotonic.return_value = 160
+        assert log_filter.filter(make_tagged_record("other"))
+        assert log_filter.filter(make_tagged_record())
+
+        [summary] = caplog.records
+        assert summary.name == "sfdo_template_helpers.logfmt_utils.sampling"
+        assert summary.tag == "log-sampling"
+        assert summary.context == {
+            "suppressed_total": 4,
+            "suppressed.noisy_tag": 3,
+            "suppressed.DEBUG": 1,
+        }
+
+    def test_summary__everything_suppressed(self, caplog, mocker):
+        caplog.set_level(logging.WARNING)
+        monotonic = mocker.patch(
+            "sfdo_template_helpers.logfmt_utils.time.monotonic", return_value=100
+        )
+        log_filter = SamplingFilter({"tags": {"noisy": {"sample_rate": 0}}})
+        for _ in range(2):
+            assert not log_filter.filter(make_tagged_record("noisy"))
+        assert not caplog.records
+
+        monotonic.return_value = 160
+        assert not log_filter.filter(make_tagged_record("noisy"))
+        [summary] = caplog.records
+        assert summary.context == {"suppressed_total": 3, "suppressed.noisy": 3}
+
+    def test_summary__waits_for_interval(self, caplog):
+        log_filter = SamplingFilter(
+            {"tags": {"noisy": {"sample_rate": 0}}}, summary_interval=3600
+        )
+        log_filter.filter(make_tagged_record("noisy"))
+        log_filter.filter(make_tagged_record())
+        assert not caplog.records
+
+    def test_unknown_option(self):
+        with pytest.raises(ValueError):
+            SamplingFilter({"tags": {"noisy": {"sample": 0.1}}})
+
+
+def log_request_id(request):
+    return HttpResponse(request_id_var.get())
+
+
+async def alog_request_id(request):
+    await asyncio.sleep(0)
+    return HttpResponse(request_id_var.get())
+
+
+class TestRequestIDMiddleware:
+    def test_header(self, rf):
+        request = rf.get("/", HTTP_X_REQUEST_ID="abc-123")
+        response = RequestIDMiddleware(log_request_id)(request)
+
+        assert response.content == b"abc-123"
+        assert request.request_id == "abc-123"
+        assert request_id_var.get() is None
+
+    @pytest.mark.parametrize("header", [None, "", 'x" y=z'])
+    def test_generated(self, rf, header):
+        extra = {} if header is None else {"HTTP_X_REQUEST_ID": header}
+        request = rf.get("/", **extra)
+        response = RequestIDMiddleware(log_request_id)(request)
+
+        assert len(response.content) == 32
+        assert response.content.decode() == request.request_id
+
+    def test_async(self, rf):
+        middleware = RequestIDMiddleware(alog_request_id)
+        assert asyncio.iscoroutinefunction(middleware)
+
+        request = rf.get("/", HTTP_X_REQUEST_ID="abc-123")
+        response = asyncio.run(middleware(request))
+
+        assert response.content == b"abc-123"
+        assert request_id_var.get() is None
+
+
+def test_copy_log_context():
+    token = request_id_var.set("abc")
+    try:
+        get_request_id = copy_log_context(request_id_var.get)
+    finally:
+        request_id_var.reset(token)
+
+    with ThreadPoolExecutor(2) as executor:
+        results = [executor.submit(get_request_id) for _ in range(4)]
+    assert [future.result() for future in results] == ["abc"] * 4
+
+
+def canonical_records(caplog):
+    return [r for r in caplog.records if getattr(r, "tag", None) == "canonical"]
+
+
+class TestCanonicalLog:
+    @pytest.mark.django_db
+    def test_canonical_log_line(self, caplog):
+        caplog.set_level(logging.INFO)
+        with canonical_log_line("Done", kind="test") as fields:
+            Foo.objects.count()
+            Foo.objects.count()
+            assert add_log_context(user="u1")
+            fields["extra"] = 1
+
+        [record] = canonical_records(caplog)
+        assert record.getMessage() == "Done"
+        assert record.context["kind"] == "test"
+        assert record.context["user"] == "u1"
+        assert record.context["extra"] == 1
+        assert record.context["db_queries"] == 2
+        assert record.context["db_time_ms"] >= 0
+        assert record.context["duration_ms"] >= record.context["db_time_ms"]
+
+    @pytest.mark.parametrize("use", ["middleware", "context manager"])
+    def test_query_recorder_connected_on_first_use(self, mocker, use):
+        mocker.patch(
+            "sfdo_template_helpers.logfmt_utils._query_recorder_connected", False
+        )
+        connect = mocker.patch.object(connection_created, "connect")
+        LogfmtFormatter().format(make_record("Not yet"))
+        assert not connect.called
+
+        for _ in range(2):
+            if use == "middleware":
+                CanonicalLogMiddleware(lambda request: HttpResponse())
+            else:
+                with canonical_log_line("Done"):
+                    pass
+        assert connect.call_count == 1
+
+    @pytest.mark.django_db
+    def test_query_recorder_inside_execute_wrapper(self, caplog):
+        caplog.set_level(logging.INFO)
+        calls = []
+
+        def wrapper(execute, sql, params, many, context):
+            calls.append(sql)
+            return execute(sql, params, many, context)
+
+        # As if the connection were opened inside the caller's block.
+        with suppress(ValueError):
+            connection.execute_wrappers.remove(_record_query)
+        with connection.execute_wrapper(wrapper):
+            with canonical_log_line("Done"):
+                Foo.objects.count()
+        assert connection.execute_wrappers == [_record_query]
+
+        Foo.objects.count()
+        assert len(calls) == 1
+        [record] = canonical_records(caplog)
+        assert record.context["db_queries"] == 1
+
+    def test_add_log_context__outside(self):
+        assert not add_log_context(user="u1")
+
+    def test_filter(self, caplog):
+        caplog.set_level(logging.INFO)
+        log_filter = CanonicalLogFilter(level="ERROR")
+        info = make_tagged_record()
+        info.context = {"step": "one"}
+        warning = make_tagged_record(level=logging.WARNING)
+        error = make_tagged_record(level=logging.ERROR)
+
+        assert log_filter.filter(info)
+        with canonical_log_line("Done"):
+            assert not log_filter.filter(info)
+            assert not log_filter.filter(warning)
+            assert log_filter.filter(error)
+
+        [record] = canonical_records(caplog)
+        assert record.context["step"] == "one"
+        assert log_filter.filter(record)
+
+    def test_middleware(self, rf, caplog):
+        caplog.set_level(logging.INFO)
+
+        def view(request):
+            add_log_context(user="u1")
+            return HttpResponse(status=204)
+
+        response = CanonicalLogMiddleware(view)(rf.post("/some/path"))
+
+        assert response.status_code == 204
+        [record] = canonical_records(caplog)
+        assert record.context["method"] == "POST"
+        assert record.context["path"] == "/some/path"
+        assert record.context["status"] == 204
+        assert record.context["user"] == "u1"
+
+    def test_middleware__error(self, rf, caplog):
+        caplog.set_level(logging.INFO)
+
+        def view(request):
+            raise ValueError
+
+        with pytest.raises(ValueError):
+            CanonicalLogMiddleware(view)(rf.get("/"))
+
+        [record] = canonical_records(caplog)
+        assert record.context["status"] == 500
+
+    def test_middleware__async(self, rf, caplog):
+        caplog.set_level(logging.INFO)
+
+        async def view(request):
+            add_log_context(user="u1")
+            return HttpResponse()
+
+        middleware = CanonicalLogMiddleware(view)
+        assert asyncio.iscoroutinefunction(middleware)
+        response = asyncio.run(middleware(rf.get("/")))
+
+        assert response.status_code == 200
+        [record] = canonical_records(caplog)
+        assert record.context["status"] == 200
+        assert record.context["user"] == "u1"
+
+    def test_with_canonical_log(self, caplog):
+        caplog.set_level(logging.INFO)
+
+        @with_canonical_log
+        def job():
+            add_log_context(rows=3)
+            return "result"
+
+        assert job() == "result"
+        [record] = canonical_records(caplog)
+        assert record.context["job"].endswith("job")
+        assert record.context["rows"] == 3
+
+
 def test_formatter__record_id():
     record = logging.LogRecord(
         "name", logging.INFO, "module", 1, "Some message", (), None
@@ -73,6 +458,67 @@ def test_formatter_format_line():
     assert result == expected
 
 
+def test_formatter_format_line__nested():
+    extra = {
+        "org": {"id": "00D", "user": {"name": "a"}},
+        "perms": ["read", {"write": False}],
+        "empty": [],
+    }
+    formatter = LogfmtFormatter()
+    expected = (
+        'org.id="00D" org.user.name="a" perms.0="read" perms.1.write=false empty="[]"'
+    )
+
+    # The second time, from the cached key paths.
+    assert formatter.format_line(extra) == expected
+    assert formatter.format_line(extra) == expected
+
+
+def test_formatter_format_line__max_depth():
+    formatter = LogfmtFormatter()
+    formatter.max_depth = 1
+    result = formatter.format_line({"a": {"b": {"c": 1}}})
+    assert result == "a.b=\"{'c': 1}\""
+
+
+def test_formatter_format_line__equal_keys_of_other_types():
+    formatter = LogfmtFormatter()
+    assert formatter.format_line({"a": ["x", "y"]}) == 'a.0="x" a.1="y"'
+    assert formatter.format_line({"a": {True: 1}}) == "a.True=1"
+    assert formatter.format_line({"a": {1.0: 1}}) == "a.1.0=1"
+    assert formatter.format_line({1: {"b": 1}}) == "1.b=1"
+    assert formatter.format_line({True: {"b": 1}}) == "True.b=1"
+
+
+def test_formatter_format_line__key_paths_bounded():
+    formatter = LogfmtFormatter()
+    formatter.max_key_paths = 2
+    for i in range(5):
+        assert formatter.format_line({f"p{i}": {i: 1}}) == f"p{i}.{i}=1"
+    assert formatter.format_line({"p": {i: 1 for i in range(5)}}).endswith("p.4=1")
+    assert len(formatter._key_paths) <= 2
+    assert all(len(paths) <= 2 for paths in formatter._key_paths.values())
+
+
+def test_formatter_format_line__other_types():
+    class Name(str):
+        def __str__(self):
+            return "name"
+
+    extra = {
+        "decimal": decimal.Decimal("1.10"),
+        "name": Name("x"),
+        "ordered": OrderedDict(a=1),
+        "row": SimpleNamespace(a=1),
+        "sequence": type("Sequence", (list,), {})([1]),
+    }
+    result = LogfmtFormatter().format_line(extra)
+
+    assert result == (
+        'decimal=1.10 name="name" ordered.a=1 row="namespace(a=1)" sequence.0=1'
+    )
+
+
 def test_formatter_tag():
     record = logging.LogRecord(
         "name", logging.INFO, "module", 1, "Some message", (), None
@@ -108,3 +554,299 @@ def test_parsed_msg():
     )
 
     assert result == expected
+
+
+def test_formatter_time__cached_per_second():
+    formatter = LogfmtFormatter()
+    record = logging.LogRecord(
+        "name", logging.INFO, "module", 1, "Some message", (), None
+    )
+    for created in (1600000000.25, 1600000000.9999996, 1600000001.0000004):
+        record.created = created
+        expected = datetime.datetime.fromtimestamp(created).strftime(
+            "%Y-%m-%d %H:%M:%S.%f"
+        )
+        assert formatter._get_time(record) == f'"{expected}"'
+
+
+def test_formatter_format__context():
+    record = logging.LogRecord("name", logging.INFO, "module", 1, 'Say "hi"', (), None)
+    record.context = {"count": 2}
+
+    result = LogfmtFormatter().format(record)
+
+    assert result.endswith(' module=module msg="Say \\"hi\\"" count=2')
+
+
+def make_record(msg="Some message"):
+    return logging.LogRecord("name", logging.INFO, "module", 1, msg, (), None)
+
+
+class BlockingStream(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def write(self, s):
+        self.release.wait()
+        return super().write(s)
+
+
+class TestQueuedLogfmtHandler:
+    def test_writes_logfmt(self):
+        stream = io.StringIO()
+        handler = QueuedLogfmtHandler(stream=stream)
+        for i in range(3):
+            handler.handle(make_record(f"Message {i}"))
+        handler.flush()
+
+        lines = stream.getvalue().splitlines()
+        assert len(lines) == 3
+        assert lines[2].endswith('module=module msg="Message 2"')
+        assert handler.stats() == {"queue_depth": 0, "dropped": 0, "written": 3}
+        handler.close()
+
+    def test_snapshots_records(self):
+        stream = BlockingStream()
+        handler = QueuedLogfmtHandler(stream=stream)
+        items = ["a"]
+        context = {"user": "u1"}
+        fields = {"status": 200}
+        record = logging.LogRecord(
+            "name", logging.INFO, "module", 1, "Items: %s", (items,), None
+        )
+        record.context = context
+        handler.handle(record)
+        handler.handle(make_record(fields))
+        items.append("b")
+        context["user"] = "u2"
+        fields["status"] = 500
+        stream.release.set()
+        handler.close()
+
+        first, second = stream.getvalue().splitlines()
+        assert first.endswith('msg="Items: [\'a\']" user="u1"')
+        assert second.endswith(" status=200")
+        assert record.args == (items,)
+
+    def test_drop_policy(self):
+        stream = BlockingStream()
+        handler = QueuedLogfmtHandler(stream=stream, queue_size=1, batch_size=1)
+        handler.handle(make_record("Written"))
+        # Wait for the writer thread to take the first record and block:
+        while handler.stats()["queue_depth"]:
+            pass
+        handler.handle(make_record("Queued"))
+        handler.handle(make_record("Dropped"))
+
+        assert handler.stats() == {"queue_depth": 1, "dropped": 1, "written": 0}
+        stream.release.set()
+        handler.close()
+        assert "Dropped" not in stream.getvalue()
+        assert handler.stats() == {"queue_depth": 0, "dropped": 1, "written": 2}
+
+    def test_block_policy(self):
+        stream = BlockingStream()
+        handler = QueuedLogfmtHandler(
+            stream=stream, queue_size=1, policy="block", block_timeout=0.01
+        )
+        handler.handle(make_record())
+        handler.handle(make_record())
+        handler.handle(make_record())
+
+        assert handler.stats()["dropped"] == 1
+        stream.release.set()
+        handler.close()
+        assert handler.stats()["written"] == 2
+
+    def test_invalid_policy(self):
+        with pytest.raises(ValueError):
+            QueuedLogfmtHandler(policy="maybe")
+
+    def test_restarts_after_fork(self):
+        stream = io.StringIO()
+        handler = QueuedLogfmtHandler(stream=stream)
+        handler.handle(make_record())
+        handler.flush()
+        handler._pid = None  # As if we'd forked since.
+
+        handler.handle(make_record())
+        handler.close()
+        assert handler.stats()["written"] == 2
+
+    def test_close_without_records(self):
+        handler = QueuedLogfmtHandler()
+        handler.flush()
+        handler.close()
+        assert handler.stats() == {"queue_depth": 0, "dropped": 0, "written": 0}
+
+    def test_message_error(self, mocker):
+        handle_error = mocker.patch.object(QueuedLogfmtHandler, "handleError")
+        handler = QueuedLogfmtHandler(stream=io.StringIO())
+        record = make_record("%s %s")
+        record.args = ("too few args",)
+        handler.handle(record)
+        handler.close()
+
+        handle_error.assert_called_once_with(record)
+        assert handler.stats()["written"] == 0
+
+    def test_format_error(self, mocker):
+        handle_error = mocker.patch.object(QueuedLogfmtHandler, "handleError")
+        mocker.patch.object(LogfmtFormatter, "format", side_effect=ValueError)
+        handler = QueuedLogfmtHandler(stream=io.StringIO())
+        handler.handle(make_record())
+        handler.close()
+
+        assert handle_error.called
+        assert handler.stats()["written"] == 0
+
+    def test_write_error(self, mocker):
+        handle_error = mocker.patch.object(QueuedLogfmtHandler, "handleError")
+        stream = io.StringIO()
+        stream.close()
+        handler = QueuedLogfmtHandler(stream=stream)
+        handler.handle(make_record())
+        handler.close()
+
+        assert handle_error.called
+        assert handler.stats()["written"] == 0
+
+
+def test_formatter_format__dict_msg():
+    record = logging.LogRecord(
+        "name",
+        logging.INFO,
+        "module",
+        1,
+        {"method": "GET", "path": '/a "b"', "status": 200},
+        (),
+        None,
+    )
+    record.context = {"user": "u1"}
+
+    result = LogfmtFormatter().format(record)
+
+    assert result.endswith(
+        ' module=module method="GET" path="/a \\"b\\"" status=200 user="u1"'
+    )
+
+
+def test_formatter_format__empty_dict_msg():
+    record = logging.LogRecord("name", logging.INFO, "module", 1, {}, (), None)
+    assert LogfmtFormatter().format(record).endswith(" module=module")
+
+
+class TestJSONLinesFormatter:
+    @pytest.fixture(params=["orjson", "json"])
+    def formatter(self, request, mocker):
+        if request.param == "json":
+            mocker.patch("sfdo_template_helpers.logfmt_utils.orjson", None)
+        return JSONLinesFormatter()
+
+    def test_format(self, formatter):
+        record = make_record('Say "hi"')
+        record.request_id = "abc"
+        record.tag = "oauth"
+        record.context = {"org": {"id": "00D"}, "ok": True, "none": None}
+        time = datetime.datetime.fromtimestamp(record.created).strftime(
+            "%Y-%m-%d %H:%M:%S.%f"
+        )
+
+        result = formatter.format(record)
+
+        assert "\n" not in result
+        assert json.loads(result) == {
+            "id": "abc",
+            "at": "INFO",
+            "time": time,
+            "tag": "oauth",
+            "module": "module",
+            "msg": 'Say "hi"',
+            "org": {"id": "00D"},
+            "ok": True,
+            "none": None,
+        }
+
+    def test_format__dict_msg(self, formatter):
+        record = make_record({"status": 200, "when": datetime.date(2020, 1, 2)})
+        result = json.loads(formatter.format(record))
+        assert result["tag"] == "external"
+        assert result["status"] == 200
+        assert result["when"] == "2020-01-02"
+        assert "msg" not in result
+
+    def test_format__parsed_msg(self, formatter):
+        record = logging.LogRecord(
+            "name", logging.INFO, "logging_middleware", 1, "foo=bar", (), None
+        )
+        assert json.loads(formatter.format(record))["foo"] == "bar"
+
+    def test_format__header_collisions(self, formatter):
+        record = make_record({"id": "from msg", "status": 200})
+        record.request_id = "abc"
+        record.context = {"id": "00D", "msg": "m", "status": 500}
+        result = json.loads(formatter.format(record))
+        assert result == {
+            **result,
+            "id": "abc",
+            "msg.id": "from msg",
+            "status": 200,
+            "context.id": "00D",
+            "msg": "m",
+            "context.status": 500,
+        }
+
+    def test_format__non_json_values(self, formatter):
+        record = make_record("Odd")
+        record.context = {
+            "nan": float("nan"),
+            "nested": {"inf": [float("inf"), 1.5], 1.5: "float key"},
+            (1, 2): "tuple key",
+        }
+
+        def invalid(constant):
+            raise ValueError(constant)
+
+        result = json.loads(formatter.format(record), parse_constant=invalid)
+        assert result == {
+            **result,
+            "nan": None,
+            "nested": {"inf": [None, 1.5], "1.5": "float key"},
+            "(1, 2)": "tuple key",
+        }
+
+    def test_format__unencodable(self, formatter):
+        record = make_record({1: decimal.Decimal("1.10"), "big": 2**70})
+        result = json.loads(formatter.format(record))
+        assert result == {**result, "1": "1.10", "big": 2**70}
+
+
+def test_request_logging_middleware(rf, caplog):
+    caplog.set_level(logging.INFO)
+    response = RequestLoggingMiddleware(lambda request: HttpResponse(status=201))(
+        rf.put("/path")
+    )
+
+    assert response.status_code == 201
+    [record] = caplog.records
+    assert record.tag == "request"
+    assert record.msg["method"] == "PUT"
+    assert record.msg["path"] == "/path"
+    assert record.msg["status"] == 201
+    assert record.msg["time_ms"] >= 0
+    assert ' method="PUT" path="/path" status=201 ' in LogfmtFormatter().format(record)
+
+
+def test_request_logging_middleware__async(rf, caplog):
+    caplog.set_level(logging.INFO)
+
+    async def view(request):
+        return HttpResponse()
+
+    middleware = RequestLoggingMiddleware(view)
+    assert asyncio.iscoroutinefunction(middleware)
+    asyncio.run(middleware(rf.get("/")))
+
+    [record] = caplog.records
+    assert record.msg["status"] == 200
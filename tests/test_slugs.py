@@ -1,6 +1,33 @@
+from io import StringIO
+
+import django
 import pytest
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError
+
+try:
+    from asgiref.sync import async_to_sync
+except ImportError:  # pragma: nocover
+    pass  # Django 2.2 doesn't install asgiref; TestAsync is skipped there.
+
+from sfdo_template_helpers.slugs import (
+    SLUG_CREATE_MAX_ATTEMPTS,
+    LocalLRUCache,
+    ResolvedSlug,
+    SlugMixin,
+    SlugRepairProgress,
+    local_slug_cache,
+    slug_creation_stats,
+)
+from tests.models import Bar, BarSlug, Foo, FooSlug
+
 
-from tests.models import Foo, FooSlug
+@pytest.fixture
+def stats():
+    slug_creation_stats.reset()
+    yield slug_creation_stats
+    slug_creation_stats.reset()
 
 
 @pytest.mark.django_db
@@ -25,6 +52,140 @@ class TestSlugMixin:
         foo.ensure_slug()
         assert foo.slugs.count() == 2
 
+    def test_find_unique_slug__suffixes(self):
+        foo = Foo.objects.create(name="Popular")
+        FooSlug.objects.bulk_create(
+            [FooSlug(parent=foo, slug=slug) for slug in ("popular", "popular-1")]
+        )
+        assert foo._find_unique_slug("popular") == "popular-2"
+
+    def test_find_unique_slug__truncates(self):
+        foo = Foo.objects.create(name="Long")
+        original = "x" * 60
+        FooSlug.objects.bulk_create(
+            [FooSlug(parent=foo, slug="x" * 50)]
+            + [FooSlug(parent=foo, slug="x" * 48 + f"-{i}") for i in range(1, 10)]
+        )
+        assert foo._find_unique_slug(original) == "x" * 47 + "-10"
+
+    def test_taken_slugs__only_candidates(self):
+        foo = Foo.objects.create(name="Taken")
+        FooSlug.objects.bulk_create(
+            [
+                FooSlug(parent=foo, slug=slug)
+                for slug in ("", "-1", "foo", "foo-1", "foo-bar", "foo-bar-2")
+            ]
+        )
+        assert foo._taken_slugs("") == {"", "-1"}
+        assert foo._taken_slugs("foo") == {"foo", "foo-1"}
+        assert "ORDER BY" not in str(foo._taken_slugs_queryset("").query)
+        # Narrowed by prefix, so the slug index applies:
+        assert "LIKE" in str(foo._taken_slugs_queryset("foo").query)
+
+    @pytest.mark.parametrize("collisions", [0, 10, 100, 2500])
+    def test_find_unique_slug__query_count(self, collisions, django_assert_num_queries):
+        foo = Foo.objects.create(name="Crowded")
+        taken = ["crowded"] + [f"crowded-{i}" for i in range(1, collisions)]
+        FooSlug.objects.bulk_create(
+            [FooSlug(parent=foo, slug=slug) for slug in taken[:collisions]]
+        )
+        expected = f"crowded-{collisions}" if collisions else "crowded"
+
+        with django_assert_num_queries(1):
+            assert foo._find_unique_slug("crowded") == expected
+
+    def test_ensure_slugs(self):
+        existing = Foo.objects.create(name="Foo")
+        existing.ensure_slug()
+        foos = [
+            Foo.objects.create(name=name) for name in ("Foo!", "Foo?", "Foo.", "Bar")
+        ]
+
+        assert Foo.ensure_slugs(Foo.objects.order_by("pk"), batch_size=3) == 4
+        assert Foo.ensure_slugs(Foo.objects.all()) == 0
+
+        assert existing.slug == "foo"
+        assert [foo.slug for foo in foos] == ["foo-1", "foo-2", "foo-3", "bar"]
+
+    def test_ensure_slugs__clears_cache(self):
+        foo = Foo.objects.create(name="Cached")
+        assert foo.slug is None
+
+        Foo.ensure_slugs([foo])
+        assert foo.slug == "cached"
+
+    @pytest.mark.parametrize("count", [10, 200])
+    def test_ensure_slugs__query_count(self, count, django_assert_num_queries):
+        Foo.objects.bulk_create([Foo(name=f"Row {i}") for i in range(count)])
+        foos = list(Foo.objects.all())
+
+        # One query for active slugs, one for exact matches, and one insert
+        # wrapped in a savepoint:
+        with django_assert_num_queries(5):
+            Foo.ensure_slugs(foos)
+
+        assert FooSlug.objects.count() == count
+
+    def test_ensure_slug__lost_race(self, mocker, stats):
+        foo = Foo.objects.create(name="Racy")
+        other = Foo.objects.create(name="Other")
+        real_taken_slugs = SlugMixin._taken_slugs
+
+        def taken_slugs(instance, original):
+            taken = real_taken_slugs(instance, original)
+            if not FooSlug.objects.filter(slug="racy").exists():
+                # Another worker takes the slug right after our lookup.
+                FooSlug.objects.create(parent=other, slug="racy")
+            return taken
+
+        mocker.patch.object(Foo, "_taken_slugs", taken_slugs)
+
+        assert foo.ensure_slug()
+        assert foo.slug == "racy-1"
+        assert stats.as_dict() == {"retries": 1, "bulk_fallbacks": 0}
+
+    def test_ensure_slug__lost_race_for_same_parent(self, mocker, stats):
+        foo = Foo.objects.create(name="Twice")
+
+        def taken_slugs(instance, original):
+            # Another worker slugs this same instance right after our lookup.
+            FooSlug.objects.create(parent=foo, slug="twice")
+            return set()
+
+        mocker.patch.object(Foo, "_taken_slugs", taken_slugs)
+
+        assert not foo.ensure_slug()
+        assert foo.slug == "twice"
+        assert stats.retries == 1
+
+    def test_ensure_slug__gives_up(self, mocker, stats):
+        other = Foo.objects.create(name="Other")
+        FooSlug.objects.create(parent=other, slug="stuck")
+        foo = Foo.objects.create(name="Stuck")
+        mocker.patch.object(Foo, "_taken_slugs", return_value=set())
+
+        with pytest.raises(IntegrityError):
+            foo.ensure_slug()
+        assert stats.retries == SLUG_CREATE_MAX_ATTEMPTS - 1
+        assert foo.slug is None
+
+    def test_ensure_slugs__lost_race(self, mocker, stats):
+        other = Foo.objects.create(name="Other")
+        foos = [Foo.objects.create(name=name) for name in ("Alpha", "Beta")]
+        real_build_slugs = Foo._build_slugs
+
+        def build_slugs(batch, claimed):
+            slugs = real_build_slugs(batch, claimed)
+            # Another worker takes one of the slugs before our insert.
+            FooSlug.objects.create(parent=other, slug="alpha")
+            return slugs
+
+        mocker.patch.object(Foo, "_build_slugs", build_slugs)
+
+        assert Foo.ensure_slugs(foos) == 2
+        assert [foo.slug for foo in foos] == ["alpha-1", "beta"]
+        assert stats.as_dict() == {"retries": 0, "bulk_fallbacks": 1}
+
     def test_no_slug(self):
         foo = Foo.objects.create(name="foonone")
         foo.ensure_slug()
@@ -59,6 +220,321 @@ class TestSlugMixin:
         assert len(slugs) == 10
         assert len(old_slugs) == 10
 
+    def test_with_slugs(self, django_assert_num_queries):
+        Foo.objects.bulk_create([Foo(name=f"Listed {i}") for i in range(500)])
+        Foo.ensure_slugs(Foo.objects.all())
+        retired = Foo.objects.get(name="Listed 0")
+        retired.slugs.update(is_active=False)
+        FooSlug.objects.create(parent=retired, slug="renamed")
+
+        with django_assert_num_queries(2):
+            foos = list(Foo.objects.with_slugs().order_by("pk"))
+            slugs = [foo.slug for foo in foos]
+            old_slugs = [foo.old_slugs for foo in foos]
+
+        assert len(slugs) == 500
+        assert slugs[0] == "renamed"
+        assert slugs[1] == "listed-1"
+        assert old_slugs == [[]] * 500
+
+
+@pytest.fixture
+def empty_caches():
+    local_slug_cache.clear()
+    cache.clear()
+    yield
+    local_slug_cache.clear()
+    cache.clear()
+
+
+@pytest.mark.django_db
+@pytest.mark.usefixtures("empty_caches")
+class TestResolve:
+    def test_canonical(self, django_assert_num_queries):
+        foo = Foo.objects.create(name="Resolved")
+        foo.ensure_slug()
+
+        with django_assert_num_queries(1):
+            assert FooSlug.resolve("resolved") == ResolvedSlug(foo.pk, "resolved", True)
+        with django_assert_num_queries(0):
+            assert FooSlug.resolve("resolved") == ResolvedSlug(foo.pk, "resolved", True)
+
+    def test_old_slug(self):
+        foo = Foo.objects.create(name="Old")
+        foo.ensure_slug()
+        foo.slugs.update(is_active=False)
+        FooSlug.objects.filter(slug="old").update(is_active=True)
+        FooSlug.objects.create(parent=foo, slug="new")
+
+        assert FooSlug.resolve("old") == ResolvedSlug(foo.pk, "new", False)
+
+    def test_missing(self, django_assert_num_queries):
+        with django_assert_num_queries(1):
+            assert FooSlug.resolve("missing") is None
+        with django_assert_num_queries(0):
+            assert FooSlug.resolve("missing") is None
+
+    def test_shared_cache(self, django_assert_num_queries):
+        foo = Foo.objects.create(name="Shared")
+        foo.ensure_slug()
+        FooSlug.resolve("shared")
+        local_slug_cache.clear()
+
+        with django_assert_num_queries(0):
+            assert FooSlug.resolve("shared").parent_id == foo.pk
+
+    def test_invalidated_on_save(self, django_capture_on_commit_callbacks):
+        foo = Foo.objects.create(name="Before")
+        assert FooSlug.resolve("before") is None
+
+        with django_capture_on_commit_callbacks(execute=True):
+            foo.ensure_slug()
+        assert FooSlug.resolve("before") == ResolvedSlug(foo.pk, "before", True)
+
+        with django_capture_on_commit_callbacks(execute=True):
+            FooSlug.objects.create(parent=foo, slug="after")
+        assert FooSlug.resolve("before") == ResolvedSlug(foo.pk, "after", False)
+
+    def test_invalidated_on_delete(self, django_capture_on_commit_callbacks):
+        foo = Foo.objects.create(name="Deleted")
+        foo.ensure_slug()
+        assert FooSlug.resolve("deleted") is not None
+
+        with django_capture_on_commit_callbacks(execute=True):
+            foo.slugs.all().delete()
+        assert FooSlug.resolve("deleted") is None
+
+    def test_invalidated_by_ensure_slugs(self, django_capture_on_commit_callbacks):
+        foo = Foo.objects.create(name="Bulk")
+        assert FooSlug.resolve("bulk") is None
+
+        with django_capture_on_commit_callbacks(execute=True):
+            Foo.ensure_slugs([foo])
+        assert FooSlug.resolve("bulk") == ResolvedSlug(foo.pk, "bulk", True)
+
+    def test_shared_cache_invalidated_on_commit(
+        self, django_capture_on_commit_callbacks
+    ):
+        foo = Foo.objects.create(name="Committed")
+        assert FooSlug.resolve("committed") is None
+
+        with django_capture_on_commit_callbacks() as callbacks:
+            foo.ensure_slug()
+        # Until the commit, other processes still see the cached miss.
+        local_slug_cache.clear()
+        assert FooSlug.resolve("committed") is None
+
+        for callback in callbacks:
+            callback()
+        assert FooSlug.resolve("committed") == ResolvedSlug(foo.pk, "committed", True)
+
+
+@pytest.mark.django_db
+@pytest.mark.skipif(django.VERSION < (4, 1), reason="The async ORM needs Django 4.1")
+class TestAsync:
+    def test_aensure_slug(self):
+        foo = Foo.objects.create(name="Async")
+        assert async_to_sync(foo.aensure_slug)()
+        assert not async_to_sync(foo.aensure_slug)()
+
+        assert async_to_sync(foo.aget_slug)() == "async"
+        assert async_to_sync(foo.aget_old_slugs)() == []
+        assert foo.slugs.count() == 1
+
+    def test_aensure_slug__collision(self):
+        Foo.objects.create(name="Async!").ensure_slug()
+        foo = Foo.objects.create(name="Async?")
+        async_to_sync(foo.aensure_slug)()
+        assert foo.slug == "async-1"
+
+    def test_aensure_slug__current_slug(self, django_assert_num_queries):
+        bar = Bar.objects.create(name="Async")
+        async_to_sync(bar.aensure_slug)()
+        assert bar.current_slug == "async"
+
+        with django_assert_num_queries(0):
+            assert async_to_sync(bar.aget_slug)() == "async"
+
+    @pytest.mark.parametrize("model", [Foo, Bar])
+    def test_aget_slug__none(self, model):
+        instance = model.objects.create(name="Nothing")
+        assert async_to_sync(instance.aget_slug)() is None
+
+    def test_aget_old_slugs(self):
+        foo = Foo.objects.create(name="Async old")
+        foo.ensure_slug()
+        FooSlug.objects.create(parent=foo, slug="async-new")
+
+        assert async_to_sync(foo.aget_slug)() == "async-new"
+        assert async_to_sync(foo.aget_old_slugs)() == ["async-old"]
+
+    def test_aensure_slug__lost_race(self, mocker, stats):
+        other = Foo.objects.create(name="Other")
+        FooSlug.objects.create(parent=other, slug="racy")
+        foo = Foo.objects.create(name="Racy")
+        mocker.patch.object(
+            Foo, "_taken_slugs_queryset", return_value=FooSlug.objects.none()
+        )
+
+        with pytest.raises(IntegrityError):
+            async_to_sync(foo.aensure_slug)()
+        assert stats.retries == SLUG_CREATE_MAX_ATTEMPTS - 1
+
+
+@pytest.mark.django_db
+class TestCurrentSlug:
+    def test_ensure_slug(self, django_assert_num_queries):
+        bar = Bar.objects.create(name="Bar")
+        bar.ensure_slug()
+        assert bar.current_slug == "bar"
+
+        bar = Bar.objects.get(pk=bar.pk)
+        with django_assert_num_queries(0):
+            assert bar.slug == "bar"
+
+    def test_ensure_slugs(self):
+        bars = [Bar.objects.create(name=name) for name in ("Bar!", "Bar?")]
+        Bar.ensure_slugs(bars)
+
+        assert [bar.current_slug for bar in bars] == ["bar", "bar-1"]
+        assert list(
+            Bar.objects.order_by("pk").values_list("current_slug", flat=True)
+        ) == [
+            "bar",
+            "bar-1",
+        ]
+
+    def test_follows_slug_changes(self):
+        bar = Bar.objects.create(name="Before")
+        bar.ensure_slug()
+        new = BarSlug.objects.create(parent=bar, slug="after")
+        bar.refresh_from_db()
+        assert bar.current_slug == "after"
+
+        new.delete()
+        bar.refresh_from_db()
+        assert bar.current_slug == "before"
+
+        bar.slugs.all().delete()
+        bar.refresh_from_db()
+        assert bar.current_slug is None
+        assert bar.slug is None
+
+    def test_sync_current_slugs(self):
+        bars = [Bar.objects.create(name=f"Bar {i}") for i in range(5)]
+        Bar.ensure_slugs(bars)
+        Bar.objects.filter(name__in=["Bar 1", "Bar 3"]).update(current_slug=None)
+
+        assert Bar.sync_current_slugs(batch_size=2, fix=False) == 2
+        assert Bar.sync_current_slugs(batch_size=2) == 2
+        assert Bar.sync_current_slugs(batch_size=2) == 0
+        assert set(Bar.objects.values_list("current_slug", flat=True)) == {
+            f"bar-{i}" for i in range(5)
+        }
+
+    def test_command(self):
+        bar = Bar.objects.create(name="Commanded")
+        bar.ensure_slug()
+        Bar.objects.update(current_slug="wrong")
+
+        with pytest.raises(CommandError):
+            call_command("sync_current_slugs", "tests.Bar", "--check")
+
+        out = StringIO()
+        call_command("sync_current_slugs", "tests.Bar", stdout=out)
+        assert out.getvalue() == "1 tests.Bar rows were out of sync.\n"
+
+        out = StringIO()
+        call_command("sync_current_slugs", "tests.Bar", "--check", stdout=out)
+        assert out.getvalue() == "0 tests.Bar rows are out of sync.\n"
+
+    @pytest.mark.parametrize("model", ["tests.Missing", "nope", "tests.Foo"])
+    def test_command__bad_model(self, model):
+        with pytest.raises(CommandError):
+            call_command("sync_current_slugs", model)
+
+
+@pytest.mark.django_db
+class TestRepairSlugs:
+    def make_foos(self):
+        foos = [Foo.objects.create(name=f"Repair {i}") for i in range(5)]
+        foos[1].ensure_slug()
+        foos[3].ensure_slug()
+        FooSlug.objects.create(parent=foos[3], slug="repair-3-new")
+        return foos
+
+    def test_repair_slugs(self):
+        foos = self.make_foos()
+
+        progress = list(Foo.repair_slugs(batch_size=2))
+
+        assert progress == [
+            SlugRepairProgress(2, foos[1].pk, 1, 0),
+            SlugRepairProgress(2, foos[3].pk, 1, 0),
+            SlugRepairProgress(1, foos[4].pk, 1, 0),
+        ]
+        assert Foo.objects.with_slugs().get(pk=foos[3].pk).old_slugs == ["repair-3"]
+
+    def test_repair_slugs__deactivate_old(
+        self, empty_caches, django_capture_on_commit_callbacks
+    ):
+        foos = self.make_foos()
+        assert FooSlug.resolve("repair-3").slug == "repair-3-new"
+
+        with django_capture_on_commit_callbacks(execute=True):
+            progress = list(
+                Foo.repair_slugs(start_after=foos[2].pk, deactivate_old=True)
+            )
+
+        assert progress == [SlugRepairProgress(2, foos[4].pk, 1, 1)]
+        assert Foo.objects.with_slugs().get(pk=foos[3].pk).old_slugs == []
+        assert FooSlug.resolve("repair-3") is None
+        assert not FooSlug.objects.filter(parent=foos[0]).exists()
+
+    def test_command(self):
+        foos = self.make_foos()
+        out = StringIO()
+
+        call_command(
+            "repair_slugs",
+            "tests.Foo",
+            "--batch-size=3",
+            f"--start-after={foos[0].pk}",
+            "--deactivate-old-slugs",
+            stdout=out,
+        )
+
+        assert out.getvalue().splitlines() == [
+            f"Processed 3 rows up to pk {foos[3].pk}: "
+            "created 1 slugs, deactivated 1 slugs.",
+            f"Processed 4 rows up to pk {foos[4].pk}: "
+            "created 2 slugs, deactivated 1 slugs.",
+            "Done. Processed 4 tests.Foo rows.",
+        ]
+
+    @pytest.mark.parametrize("model", ["tests.Missing", "tests.Markdowner"])
+    def test_command__bad_model(self, model):
+        with pytest.raises(CommandError):
+            call_command("repair_slugs", model)
+
+
+class TestLocalLRUCache:
+    def test_evicts_least_recently_used(self):
+        lru = LocalLRUCache()
+        lru.set("a", 1, 60, 2)
+        lru.set("b", 2, 60, 2)
+        assert lru.get("a") == 1
+        lru.set("c", 3, 60, 2)
+
+        assert lru.get("a") == 1
+        assert lru.get("b") is None
+        assert lru.get("c") == 3
+
+    def test_expires(self):
+        lru = LocalLRUCache()
+        lru.set("a", 1, -1, 2)
+        assert lru.get("a") is None
+
 
 def test_slug_str():
     slug = FooSlug(slug="nop")